@@ -2,10 +2,31 @@ import sqlite3
 import bcrypt
 import argparse
 import json
+import csv
+import sys
+import os
+import random
+import socket
+import struct
+import time
+import rating
+from user_columns import USER_COLUMNS
 
 
 DB_NAME = 'database.db'
 
+# Control socket of a running server, see ADMIN CONTROL in server.py
+SERVER_ADDRESS = ('127.0.0.1', 9056)
+ADMIN_ADDRESS = ('127.0.0.1', 9058)
+ADMIN_TOKEN_FILE = 'admin.token'
+ADMIN_TIMEOUT = 10
+
+# Rows per fetchmany call when streaming, and per transaction when importing or bulk updating
+FETCH_CHUNK = 5000
+WRITE_BATCH = 50000
+
+ALLOWED_USER_COLUMNS = USER_COLUMNS
+
 DEFAULT_STATS = {
     "units_destroyed": 0,
     "shortest_game": 3600,
@@ -15,8 +36,76 @@ DEFAULT_STATS = {
     "campaign_progress": []
 }
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
+def admin_token():
+    token = os.getenv('WOD_ADMIN_TOKEN')
+    if token is None:
+        try:
+            with open(ADMIN_TOKEN_FILE) as file:
+                token = file.read().strip()
+        except OSError:
+            return None
+    return token
+
+
+def admin_connection():
+    # None only when nothing listens on the admin port, the caller may then use the database file
+    try:
+        return socket.create_connection(ADMIN_ADDRESS, timeout=ADMIN_TIMEOUT)
+    except ConnectionRefusedError:
+        return None
+    except OSError as e:
+        sys.exit(f"The admin socket did not accept the connection: {e}")
+
+
+def admin_request(command, **arguments):
+    # Returns the server's response, or None when no server is running. Once a server is found
+    # every failure exits, the command may have been applied and must not be applied again
+    sock = admin_connection()
+    if sock is None:
+        return None
+
+    with sock:
+        token = admin_token()
+        if token is None:
+            sys.exit(f"The server is running but there is no admin token, set WOD_ADMIN_TOKEN or run next to {ADMIN_TOKEN_FILE}.")
+        try:
+            body = json.dumps({'token': token, 'command': command} | arguments).encode()
+            sock.sendall(struct.pack('>I', len(body)) + body)
+            file = sock.makefile('rb')
+            length = file.read(4)
+            if len(length) < 4:
+                raise ConnectionError('connection closed without a response')
+            return json.loads(file.read(struct.unpack('>I', length)[0]))
+        except (OSError, ValueError) as e:
+            sys.exit(f"No response to '{command}' from the server ({e}), check whether it was applied before retrying.")
+
+
+def require_stopped(command):
+    # Bulk commands hold the write lock for whole batches and the server would keep rating from
+    # profiles it cached before them, so they only run on the file of a stopped server
+    for address in (SERVER_ADDRESS, ADMIN_ADDRESS):
+        try:
+            socket.create_connection(address, timeout=ADMIN_TIMEOUT).close()
+        except ConnectionRefusedError:
+            continue
+        except OSError:
+            pass
+        sys.exit(f"The server is running, stop it before running '{command}'.")
+
+
+def through_server(command, **arguments):
+    # True when the running server applied the command, False to fall back to the database file
+    response = admin_request(command, **arguments)
+    if response is None:
+        return False
+    if not response.get('status'):
+        sys.exit(response.get('error'))
+    print(response.get('message'))
+    return True
+
+
+def init_db(name=DB_NAME):
+    conn = sqlite3.connect(name)
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -31,9 +120,35 @@ def init_db():
             email TEXT NULL,
             title TEXT DEFAULT NULL,
             money INTEGER DEFAULT 0,
-            items TEXT DEFAULT '[]'
+            items TEXT DEFAULT '[]',
+            campaign_mask INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS matches (
+            game_id TEXT PRIMARY KEY,
+            mode TEXT NOT NULL,
+            winner TEXT NULL,
+            started INTEGER,
+            duration INTEGER,
+            ticks INTEGER,
+            counted INTEGER,
+            rated INTEGER,
+            casualties TEXT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS match_players (
+            game_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            seat INTEGER,
+            elo_delta INTEGER DEFAULT 0,
+            started INTEGER,
+            PRIMARY KEY (game_id, username)
         )
     ''')
+    c.execute('CREATE INDEX IF NOT EXISTS matches_started ON matches (started)')
+    c.execute('CREATE INDEX IF NOT EXISTS match_players_history ON match_players (username, started)')
     conn.commit()
     conn.close()
 
@@ -76,11 +191,10 @@ def list_users():
     conn = sqlite3.connect(DB_NAME)
     c = conn.cursor()
     c.execute('SELECT username, score, money FROM users ORDER BY score DESC')
-    users = c.fetchall()
-    conn.close()
 
-    for username, score, money in users:
+    for username, score, money in stream_rows(c):
         print(f"{username}: {score}   with {money}$")
+    conn.close()
 
 
 def add_money(username, amount):
@@ -126,19 +240,6 @@ def clear_items(username):
 
 
 def update_user_field(username, field, value):
-    ALLOWED_USER_COLUMNS = {
-        "password_hash",
-        "steam_id",
-        "score",
-        "number_of_wins",
-        "number_of_games",
-        "last_active",
-        "stats",
-        "email",
-        "title",
-        "money",
-        "items",
-    }
     if field not in ALLOWED_USER_COLUMNS:
         raise ValueError(f"Invalid field name: {field}")
 
@@ -187,13 +288,319 @@ def print_database():
     # conn.commit()
 
     c.execute("SELECT * FROM users")
-    rows = c.fetchall()
     columns = [desc[0] for desc in c.description]
 
-    for row in rows:
+    for row in stream_rows(c):
         row_dict = dict(zip(columns, row))
         print(row_dict)
+    conn.close()
+
+
+def stream_rows(cursor):
+    # Keeps at most FETCH_CHUNK rows in memory
+    while True:
+        rows = cursor.fetchmany(FETCH_CHUNK)
+        if not rows:
+            return
+        yield from rows
+
+
+def open_target(path, mode):
+    # '-' is stdin or stdout
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+def export_users(output, file_format):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("SELECT * FROM users")
+    columns = [desc[0] for desc in c.description]
+    target = open_target(output, 'w')
+    start = time.perf_counter()
+    count = 0
+
+    if file_format == 'csv':
+        writer = csv.writer(target)
+        writer.writerow(columns)
+    while True:
+        rows = c.fetchmany(FETCH_CHUNK)
+        if not rows:
+            break
+        # Password hashes are stored as bytes by the server
+        rows = [[value.decode() if isinstance(value, bytes) else value for value in row] for row in rows]
+        if file_format == 'csv':
+            writer.writerows(rows)
+        else:
+            target.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+        count += len(rows)
+
+    if target is not sys.stdout:
+        target.close()
+    conn.close()
+    print(f"Exported {count} users in {time.perf_counter() - start:.2f}s.", file=sys.stderr)
+
+
+def read_records(source, file_format):
+    if file_format == 'csv':
+        for record in csv.DictReader(source):
+            # CSV has no NULL, empty fields are read back as one
+            yield {key: value if value != '' else None for key, value in record.items()}
+    else:
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_users(path, file_format, replace=False):
+    require_stopped('import')
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    source = open_target(path, 'r')
+    verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+    start = time.perf_counter()
+    count = 0
+    before = conn.total_changes
+
+    # Records are grouped by their columns, every group is one executemany
+    groups = {}
+    pending = 0
+    for record in read_records(source, file_format):
+        columns = tuple(key for key in record if key == 'username' or key in ALLOWED_USER_COLUMNS)
+        row = [record[key] for key in columns]
+        if 'password_hash' in columns:
+            index = columns.index('password_hash')
+            if isinstance(row[index], str):
+                row[index] = row[index].encode()
+        groups.setdefault(columns, []).append(row)
+        pending += 1
+        count += 1
+
+        if pending >= WRITE_BATCH:
+            write_groups(c, verb, groups)
+            conn.commit()
+            groups = {}
+            pending = 0
+
+    write_groups(c, verb, groups)
+    conn.commit()
+    added = conn.total_changes - before
+    conn.close()
+    if source is not sys.stdin:
+        source.close()
+    print(f"Read {count} users, wrote {added} in {time.perf_counter() - start:.2f}s.")
+
+
+def write_groups(c, verb, groups):
+    for columns, rows in groups.items():
+        c.executemany(f"{verb} INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+
+
+def bulk_update(command, path, query, parse):
+    # Every line of the file is one target, applied WRITE_BATCH rows per transaction
+    require_stopped(command)
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    source = open_target(path, 'r')
+    start = time.perf_counter()
+    count = 0
+    before = conn.total_changes
+
+    batch = []
+    for line in csv.reader(source):
+        if not line:
+            continue
+        batch.append(parse(line))
+        count += 1
+        if len(batch) >= WRITE_BATCH:
+            c.executemany(query, batch)
+            conn.commit()
+            batch = []
+    c.executemany(query, batch)
+    conn.commit()
 
+    changed = conn.total_changes - before
+    conn.close()
+    if source is not sys.stdin:
+        source.close()
+    print(f"Applied {count} lines, {changed} users changed in {time.perf_counter() - start:.2f}s.")
+
+
+def bulk_give(path):
+    # Lines are username,amount
+    bulk_update('bulk-give', path, 'UPDATE users SET money = money + ? WHERE username = ?', lambda line: (int(line[1]), line[0]))
+
+
+def bulk_clear(path):
+    # Lines are usernames
+    bulk_update('bulk-clear', path, 'UPDATE users SET items = ? WHERE username = ?', lambda line: (json.dumps([]), line[0]))
+
+
+def bulk_change(field, path):
+    # Lines are username,value
+    if field not in ALLOWED_USER_COLUMNS:
+        raise ValueError(f"Invalid field name: {field}")
+    bulk_update('bulk-change', path, f"UPDATE users SET {field} = ? WHERE username = ?", lambda line: (line[1], line[0]))
+
+
+
+SYNTHETIC_TITLES = ['Veteran', 'Commander', 'General', 'Strategist', 'Conqueror']
+SYNTHETIC_ITEMS = [f'item{i}' for i in range(40)]
+
+# Shape of the generated users, every key can be set from the command line
+SYNTHETIC_DISTRIBUTION = {
+    'activity': 0.8,  # Pareto shape of the games played, smaller gives a longer tail of heavy players
+    'score_spread': 120,  # standard deviation of the score around what the win rate suggests
+    'inventory_share': 1.0,  # share of users who may own items
+    'inventory_mean': 4,  # mean number of items of those users
+    'campaign_share': 1.0,  # share of users who started the campaign
+    'steam_share': 0.3,
+    'email_share': 0.85,
+}
+
+
+def synthetic_user(rng, i, password_hash, now, distribution=SYNTHETIC_DISTRIBUTION):
+    # Few players play a lot, most play a little
+    games = min(int(rng.paretovariate(distribution['activity'])) - 1, 5000)
+    wins = round(games * rng.betavariate(4, 4))
+    levels = min(30, int(rng.betavariate(0.7, 1.5) * 31)) if rng.random() < distribution['campaign_share'] else 0
+    items = 0
+    if rng.random() < distribution['inventory_share'] and distribution['inventory_mean'] > 0:
+        items = min(len(SYNTHETIC_ITEMS), int(rng.expovariate(1 / distribution['inventory_mean'])))
+    stats = {
+        "units_destroyed": games * rng.randint(5, 60),
+        "shortest_game": rng.randint(120, 3600) if wins else 3600,
+        "minimal_casualties": rng.randint(0, 100) if wins else 100,
+        "dev_defeated": rng.random() < 0.01,
+        "campaign_completed": levels >= 30,
+        "campaign_progress": sorted(rng.sample(range(1, 31), levels)),
+    }
+    campaign_mask = sum(1 << level for level in stats["campaign_progress"])
+    return (
+        f'player{i:07d}',
+        password_hash,
+        str(rng.randrange(10 ** 16, 10 ** 17)) if rng.random() < distribution['steam_share'] else None,
+        max(0, round(rng.gauss(1000 + 300 * (2 * wins / games - 1) * min(1, games / 50) if games else 1000,
+                               distribution['score_spread']))),
+        wins,
+        games,
+        now - rng.expovariate(1 / (30 * 86400)),
+        json.dumps(stats),
+        f'player{i}@example.org' if rng.random() < distribution['email_share'] else None,
+        rng.choice(SYNTHETIC_TITLES) if rng.random() < 0.1 else None,
+        rng.randint(0, 500),
+        json.dumps(rng.sample(SYNTHETIC_ITEMS, items)),
+        campaign_mask,
+    )
+
+
+def generate_database(output, users, matches, seed, force=False, distribution=None):
+    # Never writes over an existing file unless asked to, the default output is not the live database
+    if os.path.exists(output):
+        if not force:
+            print(f"{output} already exists, use --force to overwrite it.")
+            return
+        os.remove(output)
+
+    init_db(output)
+    conn = sqlite3.connect(output)
+    c = conn.cursor()
+    rng = random.Random(seed)
+    # One cheap hash for everyone, the password of all synthetic users is 'password'
+    password_hash = bcrypt.hashpw(b'password', bcrypt.gensalt(rounds=4))
+    now = time.time()
+    start = time.perf_counter()
+    distribution = SYNTHETIC_DISTRIBUTION | (distribution or {})
+
+    for first in range(0, users, WRITE_BATCH):
+        c.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                      [synthetic_user(rng, i, password_hash, now, distribution) for i in range(first, min(users, first + WRITE_BATCH))])
+        conn.commit()
+
+    # Match history over the same players, oldest first
+    started = int(now) - matches * 60
+    for first in range(0, matches, WRITE_BATCH):
+        match_rows = []
+        seat_rows = []
+        for i in range(first, min(matches, first + WRITE_BATCH)):
+            game_id = f'{i:016x}'
+            seated = [f'player{j:07d}' for j in rng.sample(range(users), 2 if rng.random() < 0.7 else rng.choice((3, 4)))]
+            winner = rng.randrange(len(seated))
+            match_rows.append((game_id, '1v1' if len(seated) == 2 else f'v{len(seated)}', seated[winner], started + i * 60,
+                               rng.randint(120, 3600), rng.randint(100, 3000), 1, 1,
+                               json.dumps([rng.randint(0, 100) for player in seated])))
+            seat_rows += [(game_id, seated[j], j, 20 if j == winner else -20, started + i * 60) for j in range(len(seated))]
+        c.executemany('INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', match_rows)
+        c.executemany('INSERT INTO match_players VALUES (?, ?, ?, ?, ?)', seat_rows)
+        conn.commit()
+
+    conn.close()
+    print(f"Generated {users} users and {matches} matches in {output} in {time.perf_counter() - start:.2f}s.")
+
+
+def recompute_ratings(initial, apply=False, force=False):
+    # Replays every rated match in the order it was played. Every player starts from initial, so
+    # this is only right when the match history goes back to the first rated game
+    if apply:
+        require_stopped('recompute-ratings')
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+
+    # Players with more counted games than recorded matches played before the history began
+    c.execute('''
+        SELECT count(*) FROM users u
+        WHERE u.number_of_games > (SELECT count(*) FROM match_players p JOIN matches m ON m.game_id = p.game_id
+                                   WHERE p.username = u.username AND m.counted = 1)
+    ''')
+    incomplete = c.fetchone()[0]
+    if incomplete:
+        print(f"{incomplete} players have games from before the match history, their ratings would restart from {initial}.")
+        if apply and not force:
+            conn.close()
+            sys.exit("Nothing written, use --force to apply anyway.")
+
+    start = time.perf_counter()
+    c.execute('''
+        SELECT m.game_id, m.winner, p.username
+        FROM matches m JOIN match_players p ON p.game_id = m.game_id
+        WHERE m.rated = 1
+        ORDER BY m.started, m.game_id, p.seat
+    ''')
+
+    games = []
+    last_game = None
+    for game_id, winner, username in c:
+        if game_id != last_game:
+            games.append(([], 0))
+            last_game = game_id
+        players = games[-1][0]
+        if username == winner:
+            games[-1] = (players, len(players))
+        players.append(username)
+    read_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ratings = rating.recompute(games, initial)
+    compute_time = time.perf_counter() - start
+
+    print(f"{len(games)} games, {len(ratings)} players, read in {read_time:.2f}s, rated in {compute_time:.2f}s"
+          f" ({'vectorized' if rating.numpy is not None else 'scalar'}).")
+    if not apply:
+        for username, score in sorted(ratings.items(), key=lambda item: -item[1])[:20]:
+            print(f"{username}: {score}")
+        print("Dry run, use --apply to save the ratings.")
+    else:
+        c.executemany('UPDATE users SET score = ? WHERE username = ?', [(score, username) for username, score in ratings.items()])
+        conn.commit()
+        print(f"Updated {len(ratings)} ratings.")
+    conn.close()
+
+
+def rating_benchmark(games, players):
+    result = rating.benchmark(games, players)
+    for key, value in result.items():
+        print(f"{key}: {value}")
 
 
 def main():
@@ -240,26 +647,117 @@ def main():
     parser_change.add_argument("username", help="Username")
 
 
+    # Export and import
+    parser_export = subparsers.add_parser("export", help="Stream all users to a file")
+    parser_export.add_argument("output", nargs="?", default="-", help="File, - for stdout")
+    parser_export.add_argument("--format", choices=("ndjson", "csv"), default="ndjson", help="Output format")
+
+    parser_import = subparsers.add_parser("import", help="Load users from an export")
+    parser_import.add_argument("input", help="File, - for stdin")
+    parser_import.add_argument("--format", choices=("ndjson", "csv"), default="ndjson", help="Input format")
+    parser_import.add_argument("--replace", action="store_true", help="Overwrite users that already exist")
+
+    # Bulk variants, one target per line of a file or stdin
+    parser_bulk = subparsers.add_parser("bulk-give", help="Give money, lines are username,amount")
+    parser_bulk.add_argument("input", help="File, - for stdin")
+
+    parser_bulk = subparsers.add_parser("bulk-clear", help="Clear items, lines are usernames")
+    parser_bulk.add_argument("input", help="File, - for stdin")
+
+    parser_bulk = subparsers.add_parser("bulk-change", help="Change a field, lines are username,value")
+    parser_bulk.add_argument("field", help="Field")
+    parser_bulk.add_argument("input", help="File, - for stdin")
+
+    # Synthetic database
+    parser_generate = subparsers.add_parser("generate", help="Generate a synthetic database for benchmarks")
+    parser_generate.add_argument("output", nargs="?", default="synthetic.db", help="Database file to create")
+    parser_generate.add_argument("--users", type=int, default=1000000, help="Number of users")
+    parser_generate.add_argument("--matches", type=int, default=0, help="Number of matches in the history")
+    parser_generate.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser_generate.add_argument("--force", action="store_true", help="Overwrite the output file")
+    for key, default in SYNTHETIC_DISTRIBUTION.items():
+        parser_generate.add_argument(f"--{key.replace('_', '-')}", type=type(default), default=default,
+                                     help=f"Distribution parameter, see SYNTHETIC_DISTRIBUTION (default {default})")
+
+    # Database benchmark
+    parser_db_benchmark = subparsers.add_parser("db-benchmark", help="Time the server's database helpers")
+    parser_db_benchmark.add_argument("database", nargs="?", default="synthetic.db", help="Database file to run against")
+    parser_db_benchmark.add_argument("--calls", type=int, default=500, help="Calls per helper and mode")
+    parser_db_benchmark.add_argument("--concurrency", type=int, default=32, help="Calls in flight in the concurrent mode")
+    parser_db_benchmark.add_argument("--warm", action="store_true", help="Load the membership index and keep the profile cache")
+
+    # Shared state benchmark
+    parser_state_benchmark = subparsers.add_parser("state-benchmark", help="Time queue joins and the state operations they make")
+    parser_state_benchmark.add_argument("--requests", type=int, default=50000, help="Requests per path")
+
+    # Maintenance on the running server
+    parser_maintenance = subparsers.add_parser("maintenance", help="Run a maintenance step on the running server now")
+    parser_maintenance.add_argument("step", choices=("backup", "optimize", "checkpoint", "replays"), help="Step to run")
+
+    # Recompute ratings
+    parser_recompute = subparsers.add_parser("recompute-ratings",
+                                             help="Recompute every rating from match history, only valid when it holds every rated game")
+    parser_recompute.add_argument("--initial", type=int, default=rating.INITIAL_RATING, help="Rating before the first game")
+    parser_recompute.add_argument("--apply", action="store_true", help="Save the ratings, by default only the top ones are printed")
+    parser_recompute.add_argument("--force", action="store_true", help="Apply even when players have games from before the history")
+
+    # Rating benchmark
+    parser_benchmark = subparsers.add_parser("rating-benchmark", help="Time batch rating against the per pair path")
+    parser_benchmark.add_argument("--games", type=int, default=300000, help="Synthetic games")
+    parser_benchmark.add_argument("--players", type=int, default=20000, help="Synthetic players")
+
     args = parser.parse_args()
 
     if args.command == "add":
         add_user(args.username, args.password)
     elif args.command == "delete":
-        delete_user(args.username)
+        if not through_server("delete", username=args.username):
+            delete_user(args.username)
     elif args.command == "changepw":
         change_password(args.username, args.new_password)
     elif args.command == "list":
         list_users()
     elif args.command == "give":
-        add_money(args.username, args.money)
+        if not through_server("give", username=args.username, amount=args.money):
+            add_money(args.username, args.money)
     elif args.command == "clear":
-        clear_items(args.username)
+        if not through_server("clear", username=args.username):
+            clear_items(args.username)
     elif args.command == "change":
-        update_user_field(args.username, args.field, args.value)
+        if not through_server("change", username=args.username, field=args.field, value=args.value):
+            update_user_field(args.username, args.field, args.value)
     elif args.command == "info":
         info(args.username)
     elif args.command == "print":
         print_database()
+    elif args.command == "export":
+        export_users(args.output, args.format)
+    elif args.command == "import":
+        import_users(args.input, args.format, args.replace)
+    elif args.command == "bulk-give":
+        bulk_give(args.input)
+    elif args.command == "bulk-clear":
+        bulk_clear(args.input)
+    elif args.command == "bulk-change":
+        bulk_change(args.field, args.input)
+    elif args.command == "generate":
+        generate_database(args.output, args.users, args.matches, args.seed, args.force,
+                          {key: getattr(args, key) for key in SYNTHETIC_DISTRIBUTION})
+    elif args.command == "db-benchmark":
+        # Imported here, it loads all of server.py
+        import db_benchmark
+        db_benchmark.run(args.database, args.calls, args.concurrency, args.warm)
+    elif args.command == "state-benchmark":
+        # Imported here, it loads all of server.py
+        import state_benchmark
+        state_benchmark.run(args.requests)
+    elif args.command == "maintenance":
+        if not through_server("maintenance", step=args.step):
+            print("The server is not running.")
+    elif args.command == "recompute-ratings":
+        recompute_ratings(args.initial, args.apply, args.force)
+    elif args.command == "rating-benchmark":
+        rating_benchmark(args.games, args.players)
     else:
         parser.print_help()
 
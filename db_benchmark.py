@@ -0,0 +1,92 @@
+import asyncio
+import random
+import sqlite3
+import time
+import server
+
+
+# Runs the server's database helpers against a database file, one call at a time and then
+# many in flight, and reports latency percentiles. Writing helpers change the database,
+# run this on a generated one (database_manager.py generate).
+
+SAMPLE_USERS = 1000
+
+
+def percentile(latencies, share):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+
+def sample(path):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute('SELECT username, email FROM users WHERE rowid IN (SELECT abs(random()) % (SELECT max(rowid) FROM users) + 1 '
+              'FROM users LIMIT ?)', (SAMPLE_USERS,))
+    rows = c.fetchall()
+    conn.close()
+    return [username for username, email in rows], [email for username, email in rows if email is not None]
+
+
+def helpers(usernames, emails, rng):
+    # name -> function starting one call
+    def score_game():
+        players = [server.Player(username, None, None, 0) for username in rng.sample(usernames, 2)]
+        stats = {'casualties': [rng.randint(0, 100), rng.randint(0, 100)], 'time': rng.randint(120, 3600)}
+        return server.score_game(players, 0, additional_info=stats)
+
+    return {
+        'get_stats': lambda: server.get_stats(rng.choice(usernames)),
+        'get_profiles': lambda: server.get_profiles(rng.sample(usernames, 4)),
+        'email_exists': lambda: server.email_exists(rng.choice(emails) if rng.random() < 0.5 else f'{rng.random()}@missing.org'),
+        'sync_campaign': lambda: server.sync_campaign(rng.choice(usernames), rng.sample(range(1, 31), rng.randint(1, 10))),
+        'campaign_delta': lambda: server.menu_campaign_delta(rng.choice(usernames), {'completed': [rng.randint(1, 30)],
+                                                                                     'known': rng.getrandbits(31)}),
+        'score_game': score_game,
+        'match_history': lambda: server.get_match_history(rng.choice(usernames)),
+    }
+
+
+async def measure(start_call, calls, concurrency, warm):
+    latencies = []
+    errors = 0
+    remaining = calls
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            if not warm:
+                server.profile_cache.clear()
+            began = time.perf_counter()
+            try:
+                await start_call()
+            except Exception as e:
+                errors += 1
+            latencies.append(time.perf_counter() - began)
+
+    began = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - began
+    latencies.sort()
+    return {'p50_ms': percentile(latencies, 0.5) * 1e3, 'p99_ms': percentile(latencies, 0.99) * 1e3,
+            'calls_per_second': calls / elapsed, 'errors': errors}
+
+
+async def run_all(path, calls, concurrency, warm):
+    server.database_name = path
+    await asyncio.to_thread(server.init_matches)
+    if warm:
+        await server.load_membership_index()
+
+    usernames, emails = sample(path)
+    rng = random.Random(0)
+    print(f"{path}, {'warm' if warm else 'cold'} caches, {calls} calls per helper")
+    print(f"{'helper':<15}{'mode':<14}{'p50 ms':>10}{'p99 ms':>10}{'calls/s':>10}{'errors':>8}")
+    for name, start_call in helpers(usernames, emails, rng).items():
+        for mode, in_flight in (('isolated', 1), (f'concurrent {concurrency}', concurrency)):
+            result = await measure(start_call, calls, in_flight, warm)
+            print(f"{name:<15}{mode:<14}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                  f"{result['calls_per_second']:>10.0f}{result['errors']:>8}")
+
+
+def run(path, calls=500, concurrency=32, warm=False):
+    asyncio.run(run_all(path, calls, concurrency, warm))
@@ -0,0 +1,155 @@
+import asyncio
+import time
+import random
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+K = 50
+INITIAL_RATING = 1000
+
+
+# The winner gains from every other player what that player loses,
+# k times how unlikely the win was against them.
+
+def expected_score(r1, r2):
+    return 1 / (1 + 10 ** ((r2 - r1) / 400))
+
+
+def elo_changes(scores, winner, k=K):
+    # One game, plain Python. Returns the rounded change of every seat
+    deltas = [0.0 for score in scores]
+    for i in range(len(scores)):
+        if i != winner:
+            delta = k * (1 - expected_score(scores[winner], scores[i]))
+            deltas[winner] += delta
+            deltas[i] -= delta
+    return [round(scores[i] + deltas[i]) - scores[i] for i in range(len(scores))]
+
+
+def batch_elo_changes(scores, winners, seats, k=K):
+    # Many independent games at once. scores is (games, max seats), seats marks the used seats,
+    # winners holds the winning seat of every game. Returns the rounded changes, same shape as scores
+    rows = numpy.arange(len(scores))
+    winner_scores = scores[rows, winners][:, None]
+    deltas = k * (1 - 1 / (1 + 10 ** ((scores - winner_scores) / 400)))
+    deltas[~seats] = 0
+    deltas[rows, winners] = 0
+    deltas = -deltas
+    deltas[rows, winners] = -deltas.sum(axis=1)
+    return numpy.round(scores + deltas) - scores
+
+
+def schedule(flat, lengths, players):
+    # Puts every game in the first round after the previous games of all its players,
+    # games of one round share no player and can be rated together. flat holds the player
+    # numbers of all games one after the other. Returns the round of every game
+    last_round = [-1] * players
+    rounds = []
+    position = 0
+    for length in lengths:
+        seated = flat[position:position + length]
+        position += length
+        round_number = 1 + max([last_round[player] for player in seated])
+        for player in seated:
+            last_round[player] = round_number
+        rounds.append(round_number)
+    return rounds
+
+
+def recompute(games, initial=INITIAL_RATING, k=K):
+    # games is [(usernames by seat, winning seat)...] in the order they were played.
+    # Returns {username: rating}, vectorized per round when numpy is there
+    if numpy is None:
+        return recompute_scalar(games, initial, k)
+    if not games:
+        return {}
+
+    names = {}
+    flat = [names.setdefault(player, len(names)) for players, winner in games for player in players]
+    lengths = [len(players) for players, winner in games]
+    rounds = numpy.array(schedule(flat, lengths, len(names)))
+
+    # Seat matrix, unused seats point at an extra rating that is never read back
+    lengths = numpy.array(lengths)
+    rows = numpy.repeat(numpy.arange(len(games)), lengths)
+    columns = numpy.arange(len(flat)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    indexes = numpy.full((len(games), lengths.max()), len(names), dtype=numpy.int64)
+    indexes[rows, columns] = flat
+    seats = indexes < len(names)
+    winners = numpy.fromiter((winner for players, winner in games), dtype=numpy.int64, count=len(games))
+    ratings = numpy.full(len(names) + 1, float(initial))
+
+    # Stable, so games keep their order inside a round
+    order = numpy.argsort(rounds, kind='stable')
+    bounds = numpy.flatnonzero(numpy.diff(rounds[order])) + 1
+    for batch in numpy.split(order, bounds):
+        batch_indexes = indexes[batch]
+        batch_seats = seats[batch]
+        changes = batch_elo_changes(ratings[batch_indexes], winners[batch], batch_seats, k)
+        # Nobody plays twice in a round, so the unused seats are the only repeated indexes
+        ratings[batch_indexes[batch_seats]] += changes[batch_seats]
+
+    return {player: int(ratings[index]) for player, index in names.items()}
+
+
+def recompute_scalar(games, initial=INITIAL_RATING, k=K):
+    ratings = {}
+    for players, winner in games:
+        scores = [ratings.get(player, initial) for player in players]
+        changes = elo_changes(scores, winner, k)
+        for i in range(len(players)):
+            ratings[players[i]] = scores[i] + changes[i]
+    return ratings
+
+
+def synthetic_games(games, players, seed=0):
+    generator = random.Random(seed)
+    names = [f'player{i}' for i in range(players)]
+    history = []
+    for i in range(games):
+        seated = generator.sample(names, 2 if generator.random() < 0.7 else generator.choice((3, 4)))
+        history.append((seated, generator.randrange(len(seated))))
+    return history
+
+
+async def per_pair_elo(score_a, score_b, k=K):
+    # How the server used to rate, one awaited call per winner and loser pair
+    return k * (1 - expected_score(score_a, score_b))
+
+
+async def recompute_per_pair(games, initial=INITIAL_RATING, k=K):
+    ratings = {}
+    for players, winner in games:
+        scores = [ratings.get(player, initial) for player in players]
+        deltas = [0 for player in players]
+        for i in range(len(players)):
+            if i != winner:
+                delta = await per_pair_elo(scores[winner], scores[i], k)
+                deltas[winner] += delta
+                deltas[i] -= delta
+        for i in range(len(players)):
+            ratings[players[i]] = round(scores[i] + deltas[i])
+    return ratings
+
+
+def benchmark(games=300000, players=20000):
+    history = synthetic_games(games, players)
+    result = {'games': games, 'players': players}
+
+    start = time.perf_counter()
+    per_pair = asyncio.run(recompute_per_pair(history))
+    result['per_pair_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scalar = recompute_scalar(history)
+    result['scalar_seconds'] = time.perf_counter() - start
+
+    if numpy is not None:
+        start = time.perf_counter()
+        vectorized = recompute(history)
+        result['vectorized_seconds'] = time.perf_counter() - start
+        result['identical'] = vectorized == scalar == per_pair
+    return result
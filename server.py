@@ -8,22 +8,51 @@ import socket
 from email.message import EmailMessage
 import aiosmtplib
 import os
+import sys
+import signal
+import subprocess
 import json
+import hashlib
+import hmac
+import zlib
+import queue
+import bisect
+import threading
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import orjson
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from state_registry import Registry, TTLRegistry
+from user_columns import USER_COLUMNS
+import rating
+from collections import OrderedDict, Counter, deque
 # import boto3
 
 
-online_users = set()
-rooms = {}
+PENDING_CODE_TTL = 1800  # 30 minutes
+
+online_users = Registry()
+rooms = Registry()
 database_name = 'database.db'
 queue_1v1 = None
 queue_v3 = None
 queue_v4 = None
 queue_v34 = None
-online_users_lock = None
-room_lock = None
-pending_codes = {}
-pending_codes_lock = None
+match_results = None
+pending_codes = TTLRegistry(PENDING_CODE_TTL)
+game_tasks = set()
+pending_snapshots = {}
+snapshot_stats = Counter()
+orphaned_games = Registry()
+live_games = Registry()
+waiting_counts = Counter()
+loop_lag = {'last': 0.0, 'max': 0.0, 'total': 0.0}
+draining = False
+shutdown_event = None
+ping_semaphore = None
 
 # EMAIL_USER = os.getenv("EMAIL_USER")
 # EMAIL_PASS = os.getenv("EMAIL_PASS")
@@ -47,6 +76,155 @@ DEFAULT_STATS = {
     "campaign_progress": []
 }
 
+PROFILE_CACHE_SIZE = 10000
+
+# TCP keepalive lets the kernel notice silently dropped peers
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# Optional "check" ping of waiting players, 0 disables it
+PING_SWEEP_INTERVAL = 30
+PING_SWEEP_CONCURRENCY = 64
+
+# Seconds between repeated lobby state pushes when nothing changed
+ROOM_KEEPALIVE = 4
+
+# Admission control
+MAX_REQUEST_FRAME = 64 * 1024
+MAX_MAP_FRAME = 4 * 1024 * 1024
+MAX_INGAME_FRAME = 1024 * 1024
+MAX_ACTIVE_HANDLERS = 2000
+IP_REQUEST_RATE = 5  # requests per second
+IP_REQUEST_BURST = 20
+MAX_TRACKED_IPS = 100000
+
+# Persistent menu connections
+LOBBY_IDLE_TIMEOUT = 300
+LOBBY_MAX_IN_FLIGHT = 8
+MAX_LOBBY_SESSIONS = 5000  # counted apart from MAX_ACTIVE_HANDLERS
+
+# Seconds per game tick
+TICK_SECONDS = 1.03
+TICK_SLOTS = 32  # phases a tick is split into, games are spread over them
+SETTLE_TIMEOUT = 10  # seconds all players together have to confirm the end of a game
+
+# Crash-resume snapshots of running games
+SNAPSHOT_DB = 'snapshots.db'
+SNAPSHOT_TICKS = 5  # ticks between snapshots of one game
+SNAPSHOT_FLUSH_INTERVAL = 2
+RESUME_WINDOW = 120  # seconds players have to come back after a restart
+
+# Database maintenance, run when few games are live unless it is long overdue
+MAINTENANCE_CHECK_INTERVAL = 60
+MAINTENANCE_MAX_GAMES = 20  # live games up to which the server counts as lightly loaded
+CHECKPOINT_INTERVAL = 300
+OPTIMIZE_INTERVAL = 3600
+ANALYZE_LIMIT = 1000  # rows sampled per index by ANALYZE
+BACKUP_INTERVAL = 6 * 3600
+BACKUP_DIR = 'backups'
+BACKUP_KEEP = 4
+BACKUP_PAGES = 256  # pages copied per backup step, the database is only locked during a step
+BACKUP_STEP_PAUSE = 0.02
+
+# Campaign levels, the campaign is completed with CAMPAIGN_LEVELS of them
+CAMPAIGN_LEVELS = 30
+CAMPAIGN_MAX_LEVEL = 63  # level numbers have to fit into the 64 bit mask column
+
+# Match history, written in batches by a background task
+MATCH_BATCH = 500
+MATCH_FLUSH_INTERVAL = 1
+MATCH_HISTORY_LIMIT = 50  # most matches one history request returns
+
+# Seconds a disconnected player's slot is held in a running game
+RECONNECT_GRACE = 20
+
+# Spectators get at most this many queued frames before skipping to the latest one
+SPECTATOR_BUFFER = 30
+SPECTATOR_DELAY = 0  # ticks spectators are kept behind the players
+
+# Structured logging, written by a background thread
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE')
+LOG_SAMPLE_RATES = {
+    # High volume events, share of them that is logged
+    'queue-join': 0.1,
+    'room-join': 0.1,
+    'spectate': 0.1,
+}
+
+# Metrics listener, only reachable from the machine itself
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9057
+LOOP_LAG_INTERVAL = 0.5
+
+# Admin control socket used by database_manager.py, token from the environment or generated into the file
+ADMIN_HOST = '127.0.0.1'
+ADMIN_PORT = 9058
+ADMIN_TOKEN = os.getenv('WOD_ADMIN_TOKEN')
+ADMIN_TOKEN_FILE = 'admin.token'
+
+# Profiling mode, samples the loop's stack whenever it is blocked for longer than the threshold
+PROFILE = os.getenv('WOD_PROFILE') == '1'
+PROFILE_THRESHOLD = 0.05
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = 'profiles'
+
+# Replay recording of every game tick
+RECORD_REPLAYS = os.getenv('WOD_RECORD_REPLAYS') == '1'
+REPLAY_DIR = 'replays'
+REPLAY_MAX_AGE = 14 * 86400  # seconds a replay is kept
+REPLAY_KEEP = 20000  # newest replays kept at most
+REPLAY_PRUNE_INTERVAL = 3600
+
+# Custom maps kept in memory, shared by all rooms
+MAP_STORE_SIZE = 256
+MAP_STORE_MAX_BYTES = 64 * 1024 * 1024
+
+
+# LOGGING
+
+log = logging.getLogger('warofdots')
+log_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname, 'event': record.getMessage()}
+        entry |= getattr(record, 'fields', {})
+        return orjson.dumps(entry, default=str).decode()
+
+
+def setup_logging():
+    global log_listener
+
+    handler = logging.FileHandler(LOG_FILE) if LOG_FILE else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+
+    # The event loop only puts records on a queue, the listener thread does the writing
+    log_queue = queue.SimpleQueue()
+    log.addHandler(QueueHandler(log_queue))
+    try:
+        log.setLevel(LOG_LEVEL)
+        unknown_level = None
+    except ValueError:
+        log.setLevel(logging.INFO)
+        unknown_level = LOG_LEVEL
+    log.propagate = False
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+    if unknown_level is not None:
+        log_event('log-level-unknown', logging.WARNING, log_level=unknown_level, using='INFO')
+
+
+def log_event(event, level=logging.INFO, **fields):
+    if not log.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE_RATES.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    log.log(level, event, extra={'fields': fields})
+
 
 class Player:
     def __init__(self, username, reader, writer, score):
@@ -54,6 +232,292 @@ class Player:
         self.reader = reader
         self.writer = writer
         self.score = score
+        self.disconnected = False
+
+        # Bumped whenever the connection is replaced by a reconnect
+        self.generation = 0
+
+    @property
+    def protocol(self):
+        transport = getattr(self.writer, 'transport', None)
+        return transport.get_protocol() if transport is not None else None
+
+    @property
+    def connected(self):
+        if self.writer.is_closing():
+            return False
+        return not getattr(self.protocol, 'lost', False)
+
+
+# Connection liveness derived from transport events instead of pings
+
+class ClientProtocol(asyncio.StreamReaderProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lost = False
+        self.on_lost = None
+
+    def mark_lost(self):
+        if self.lost:
+            return
+        self.lost = True
+        if self.on_lost is not None:
+            callback, self.on_lost = self.on_lost, None
+            callback()
+
+    def eof_received(self):
+        self.mark_lost()
+        return super().eof_received()
+
+    def connection_lost(self, exc):
+        self.mark_lost()
+        super().connection_lost(exc)
+
+
+def watch_waiting(player):
+    # While a player waits in a queue or room, a lost connection frees them right away
+    protocol = player.protocol
+    if not isinstance(protocol, ClientProtocol):
+        return
+    if protocol.lost:
+        asyncio.create_task(disconnect(player))
+    else:
+        protocol.on_lost = lambda: asyncio.create_task(disconnect(player))
+
+
+def unwatch_waiting(player):
+    protocol = player.protocol
+    if isinstance(protocol, ClientProtocol):
+        protocol.on_lost = None
+
+
+def set_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+
+
+# Read-through cache of user profile records
+
+class ProfileCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.records = OrderedDict()
+        # Every invalidation is a new generation. invalidated holds the generation of the latest
+        # invalidation per user for the most recent users, older ones are folded into floor
+        self.generation = 0
+        self.invalidated = OrderedDict()
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        record = self.records.get(username)
+        if record is None:
+            self.misses += 1
+            return None
+        self.records.move_to_end(username)
+        self.hits += 1
+        return record
+
+    def put(self, username, record, generation):
+        # The user was written to while the record was being loaded, so it may be stale
+        if generation < self.floor or self.invalidated.get(username, 0) > generation:
+            return
+        self.records[username] = record
+        self.records.move_to_end(username)
+        while len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+
+    def invalidate(self, *usernames):
+        self.generation += 1
+        for username in usernames:
+            self.records.pop(username, None)
+            self.invalidated[username] = self.generation
+            self.invalidated.move_to_end(username)
+        while len(self.invalidated) > self.max_size:
+            username, generation = self.invalidated.popitem(last=False)
+            self.floor = max(self.floor, generation)
+
+    def clear(self):
+        self.generation += 1
+        self.floor = self.generation
+        self.invalidated.clear()
+        self.records.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self.records), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE)
+
+
+def load_profiles(usernames):
+    # Blocking, must be called in a thread
+    conn = sqlite3.connect(database_name)
+    c = conn.cursor()
+    records = {}
+
+    usernames = list(usernames)
+    for start in range(0, len(usernames), 500):
+        chunk = usernames[start:start + 500]
+        c.execute(f"SELECT username, score, title, number_of_games, number_of_wins, money, items, stats FROM users "
+                  f"WHERE username IN ({', '.join('?' for _ in chunk)})", chunk)
+        for row in c.fetchall():
+            try:
+                other_stats = json.loads(row[7]) if row[7] else {}
+            except json.JSONDecodeError:
+                other_stats = {}
+
+            records[row[0]] = {'score': row[1], 'title': row[2], 'number_of_games': row[3],
+                               'number_of_wins': row[4], 'money': row[5], 'items': json.loads(row[6]),
+                               'stats': DEFAULT_STATS.copy() | other_stats}
+
+    conn.close()
+    return records
+
+
+async def get_profiles(usernames):
+    profiles = {}
+    missing = []
+    for username in usernames:
+        record = profile_cache.get(username)
+        if record is None:
+            missing.append(username)
+        else:
+            profiles[username] = record
+
+    if missing:
+        generation = profile_cache.generation
+        loaded = await asyncio.to_thread(load_profiles, missing)
+        for username, record in loaded.items():
+            profile_cache.put(username, record, generation)
+        profiles |= loaded
+
+    return profiles
+
+
+async def get_profile(username):
+    profiles = await get_profiles([username])
+    return profiles.get(username)
+
+
+# In-memory index of taken usernames, emails and steam ids
+
+class MembershipIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # Lookups go to the database until the index is loaded again
+        self.loaded = False
+        self.accounts = {}
+        self.emails = Counter()
+        self.steam_ids = Counter()
+
+    def add(self, username, email, steam_id):
+        self.remove(username)
+        self.accounts[username] = (email, steam_id)
+        if email is not None:
+            self.emails[email] += 1
+        if steam_id is not None:
+            self.steam_ids[steam_id] += 1
+
+    def remove(self, username):
+        if username not in self.accounts:
+            return
+        email, steam_id = self.accounts.pop(username)
+        if email is not None:
+            self.emails[email] -= 1
+            if self.emails[email] <= 0:
+                del self.emails[email]
+        if steam_id is not None:
+            self.steam_ids[steam_id] -= 1
+            if self.steam_ids[steam_id] <= 0:
+                del self.steam_ids[steam_id]
+
+    def set_steam_id(self, username, steam_id):
+        if username in self.accounts:
+            self.add(username, self.accounts[username][0], steam_id)
+
+
+membership = MembershipIndex()
+
+
+async def load_membership_index():
+    def blocking_load():
+        conn = sqlite3.connect(database_name)
+        c = conn.cursor()
+
+        # Indexes keep the database fallback from scanning the whole table
+        c.execute('CREATE INDEX IF NOT EXISTS users_email ON users (email)')
+        c.execute('CREATE INDEX IF NOT EXISTS users_steam_id ON users (steam_id)')
+        conn.commit()
+
+        c.execute('SELECT username, email, steam_id FROM users')
+        rows = c.fetchall()
+        conn.close()
+        return rows
+
+    rows = await asyncio.to_thread(blocking_load)
+    for username, email, steam_id in rows:
+        membership.add(username, email, steam_id)
+    membership.loaded = True
+    log_event('membership-loaded', users=len(membership.accounts))
+
+
+# Content addressed store of custom maps
+
+class MapEntry:
+    def __init__(self, map_hash, data):
+        self.hash = map_hash
+        # Only the serialized form is kept, it is what the byte budget counts. Parsing validates the upload
+        self.data = orjson.dumps(orjson.loads(data))
+
+
+class MapStore:
+    def __init__(self, max_size, max_bytes):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, map_hash):
+        entry = self.entries.get(map_hash)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(map_hash)
+        self.hits += 1
+        return entry
+
+    def add(self, data):
+        map_hash = hashlib.sha256(data).hexdigest()
+        if map_hash in self.entries:
+            self.entries.move_to_end(map_hash)
+            return self.entries[map_hash]
+
+        entry = MapEntry(map_hash, data)
+        self.entries[map_hash] = entry
+        self.total_bytes += len(entry.data)
+        while len(self.entries) > 1 and (len(self.entries) > self.max_size or self.total_bytes > self.max_bytes):
+            _, removed = self.entries.popitem(last=False)
+            self.total_bytes -= len(removed.data)
+        return entry
+
+    def stats(self):
+        return {'size': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+map_store = MapStore(MAP_STORE_SIZE, MAP_STORE_MAX_BYTES)
 
 
 # Everything needed to create a game room
@@ -66,85 +530,146 @@ class GameRoom:
         self.nplayers = 2 if self.mode == '1v1' else 3 if self.mode == 'v3' else 4
 
         self.ready = False
+        self.started = False
 
-        if custom_map is None:
-            self.custom_map = None
-        else:
-            self.custom_map = orjson.loads(custom_map)
+        # Player messages and departures, consumed by the room supervisor
+        self.events = asyncio.Queue()
+        self.readers = {}
+        self.supervisor = None
+        self.last_state = None
+
+        # MapEntry from the map store, its serialized form is reused for every joining player
+        self.custom_map = custom_map
+        self.room_info = b'{"mode":' + orjson.dumps(self.mode) + b',"map":' + (custom_map.data if custom_map else b'null') + b',"players":'
 
     async def add_player(self, player):
         self.players.append(player)
         if not len(self.players) == 1:
-            await send_orjson(player.writer, orjson.dumps({'mode': self.mode, 'map': self.custom_map, 'players': [self.players[i].username for i in range(len(self.players))]}))
+            await send_orjson(player.writer, self.room_info + orjson.dumps([self.players[i].username for i in range(len(self.players))]) + b'}')
 
         if len(self.players) >= self.nplayers:
             self.ready = True
 
-    async def start(self):
-        if len(self.players) > self.nplayers:
-            spectators = self.players[self.nplayers:]
+        self.readers[player] = asyncio.create_task(self.read_player(player))
+        if self.supervisor is None:
+            self.supervisor = asyncio.create_task(self.supervise())
         else:
-            spectators = None
+            self.events.put_nowait(('joined', player, None))
 
-        if self.mode == '1v1':
-            asyncio.create_task(game_session('1v1', self.players[:self.nplayers], score=False, spectators=spectators))
-        if self.mode == 'v3':
-            asyncio.create_task(game_session('v3', self.players[:self.nplayers], score=False, spectators=spectators))
-        if self.mode == 'v4':
-            asyncio.create_task(game_session('v4', self.players[:self.nplayers], score=False, spectators=spectators))
-
-        await delete_game_room(self.code)
-
-    async def check_room(self):
-        info = {'players': [self.players[i].username for i in range(len(self.players))]}
-        for i in range(len(self.players) - 1, -1, -1):
-            if i == 0:
-                info['ready'] = self.ready
-            response = await is_connected_vroom(self.players[i], info)
-            if response:
-                if i == 0:
-                    if 'action' in response and response['action'] == 'start':
+    async def read_player(self, player):
+        while True:
+            message = await read_orjson(player.reader)
+            if message == 0:
+                # A quiet but connected player only hit the read timeout
+                if player.connected:
+                    continue
+                self.events.put_nowait(('left', player, None))
+                return
+
+            try:
+                message = orjson.loads(message)
+            except orjson.JSONDecodeError:
+                continue
+            self.events.put_nowait(('message', player, message))
+
+    async def remove_player(self, player):
+        if player not in self.players:
+            return
+        reader = self.readers.pop(player, None)
+        if reader is not None:
+            reader.cancel()
+        self.players.remove(player)
+        await disconnect(player)
+
+        if len(self.players) >= self.nplayers:
+            self.ready = True
+        else:
+            self.ready = False
+
+    async def push_state(self, force=False):
+        usernames = [self.players[i].username for i in range(len(self.players))]
+        state = (tuple(usernames), self.ready)
+        if state == self.last_state and not force:
+            return
+        self.last_state = state
+
+        # Only the host is told whether the room is ready
+        info = orjson.dumps({'players': usernames, 'action': 'check'})
+        host_info = orjson.dumps({'players': usernames, 'ready': self.ready, 'action': 'check'})
+        players = list(self.players)
+        statuses = await asyncio.gather(*[send_orjson(players[i].writer, host_info if i == 0 else info) for i in range(len(players))])
+        for i in range(len(players)):
+            if not statuses[i]:
+                await self.remove_player(players[i])
+
+    async def supervise(self):
+        try:
+            await self.push_state()
+            while self.players:
+                try:
+                    kind, player, message = await asyncio.wait_for(self.events.get(), timeout=ROOM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Clients answer the host's start only in reply to a push, so repeat it now and then
+                    await self.push_state(force=True)
+                    continue
+
+                if kind == 'left':
+                    await self.remove_player(player)
+                elif kind == 'drain':
+                    # New players are refused while draining, so the room could never fill up
+                    for player in list(self.players):
+                        await send_orjson(player.writer, orjson.dumps({'status': 0, 'error': 'server-draining'}))
+                        await self.remove_player(player)
+                    return
+                elif kind == 'message' and self.players and player is self.players[0]:
+                    if message.get('action') == 'start':
                         await self.start()
-            else:
-                await disconnect(self.players[i])
-                self.players.remove(self.players[i])
+                        return
 
-                if len(self.players) >= self.nplayers:
-                    self.ready = True
-                else:
-                    self.ready = False
+                await self.push_state()
 
-        if not self.players:
-            await delete_game_room(self.code)
+        except Exception as e:
+            log_event('room-error', logging.ERROR, code=self.code, error=str(e))
 
+        finally:
+            if not self.started:
+                for player in list(self.players):
+                    await self.remove_player(player)
+                delete_game_room(self.code)
 
-async def create_game_room(code, room):
-    async with room_lock:
-        rooms[code] = room
+    async def start(self):
+        self.started = True
+        delete_game_room(self.code)
 
+        # The game session reads from the players from now on
+        for reader in self.readers.values():
+            reader.cancel()
+        await asyncio.gather(*self.readers.values(), return_exceptions=True)
+        self.readers.clear()
 
-async def delete_game_room(code):
-    async with room_lock:
-        del rooms[code]
+        if len(self.players) > self.nplayers:
+            spectators = self.players[self.nplayers:]
+        else:
+            spectators = None
 
+        if self.mode == '1v1':
+            start_game('1v1', self.players[:self.nplayers], score=False, spectators=spectators)
+        if self.mode == 'v3':
+            start_game('v3', self.players[:self.nplayers], score=False, spectators=spectators)
+        if self.mode == 'v4':
+            start_game('v4', self.players[:self.nplayers], score=False, spectators=spectators)
 
-async def room_exists(code):
-    async with room_lock:
-        return code in rooms
 
+def create_game_room(code, room):
+    rooms.set(code, room)
 
-async def is_connected_vroom(player, info):
-    try:
-        info['action'] = 'check'
-        if await send_orjson(player.writer, orjson.dumps(info)) == 0:
-            return False
 
-        response = await asyncio.wait_for(read_orjson(player.reader), timeout=1)
+def delete_game_room(code):
+    rooms.pop(code)
 
-        return orjson.loads(response)
 
-    except Exception as e:
-        return False
+def room_exists(code):
+    return code in rooms
 
 
 # Everything needed to create a new account
@@ -156,6 +681,9 @@ async def generate_password(len):
 
 
 async def user_exists(username):
+    if membership.loaded:
+        return username in membership.accounts
+
     def blocking_check():
         conn = sqlite3.connect(database_name)
         c = conn.cursor()
@@ -168,6 +696,9 @@ async def user_exists(username):
 
 
 async def email_exists(email):
+    if membership.loaded:
+        return email in membership.emails
+
     def blocking_check():
         conn = sqlite3.connect(database_name)
         c = conn.cursor()
@@ -180,6 +711,9 @@ async def email_exists(email):
 
 
 async def steam_id_exists(steam_id):
+    if membership.loaded:
+        return steam_id in membership.steam_ids
+
     def blocking_check():
         conn = sqlite3.connect(database_name)
         c = conn.cursor()
@@ -227,7 +761,10 @@ async def add_user(username, password, email, steam_id):
         finally:
             conn.close()
 
-    return await asyncio.to_thread(blocking_add)
+    status = await asyncio.to_thread(blocking_add)
+    if status:
+        membership.add(username, email, steam_id)
+    return status
 
 
 async def delete_user(username):
@@ -239,6 +776,8 @@ async def delete_user(username):
         conn.close()
 
     await asyncio.to_thread(blocking_delete)
+    membership.remove(username)
+    profile_cache.invalidate(username)
 
 
 async def get_username(steam_id):
@@ -270,7 +809,10 @@ async def add_steam_id(username, steam_id):
         finally:
             conn.close()
 
-    return await asyncio.to_thread(blocking_change)
+    status = await asyncio.to_thread(blocking_change)
+    if status:
+        membership.set_steam_id(username, steam_id)
+    return status
 
 
 
@@ -376,7 +918,7 @@ async def send_email(text: str, email: str) -> int:
         )
         return 1
     except Exception as e:
-        print("Mailgun error:", e)
+        log_event('email-error', logging.ERROR, error=str(e))
         return 0
 
 async def register_user(username, email):
@@ -391,8 +933,7 @@ async def register_user(username, email):
     if not status:
         return 0, 'username_taken'
     code = await generate_password(4)
-    async with pending_codes_lock:
-        pending_codes[username] = code
+    pending_codes.set(username, code)
     status = await send_email(f"""
         Hi {username},
 
@@ -413,6 +954,15 @@ async def register_user(username, email):
     return 1, None
 
 
+async def expire_registration(username):
+    await asyncio.sleep(PENDING_CODE_TTL)
+    status = await check_if_active(username)
+    if not status:
+        # Done only if no confirmation appeared
+        pending_codes.pop(username)
+        await delete_user(username)
+
+
 async def login1(username, email):
     status = await user_exists(username)
     if not status:
@@ -421,8 +971,7 @@ async def login1(username, email):
     if email != real_email[0]:
         return 0, 'email_does_not_match'
     code = await generate_password(4)
-    async with pending_codes_lock:
-        pending_codes[username] = code
+    pending_codes.set(username, code)
 
     status = await send_email(f"""
         Hi {username},
@@ -444,11 +993,7 @@ async def login1(username, email):
 
 
 async def login2(username, code, steam_id=None):
-    async with pending_codes_lock:
-        if username in pending_codes:
-            real_code = pending_codes[username]
-        else:
-            real_code = None
+    real_code = pending_codes.get(username)
 
     if real_code is None:
         return 0, None, 'expired_code'
@@ -520,7 +1065,10 @@ async def set_title(username, title):
         conn.close()
         return
 
-    return await asyncio.to_thread(blocking_get)
+    try:
+        return await asyncio.to_thread(blocking_get)
+    finally:
+        profile_cache.invalidate(username)
 
 
 async def buy_item(username, item, price):
@@ -551,127 +1099,147 @@ async def buy_item(username, item, price):
 
     if price < 0:
         return 0, 'invalid-price'
-    status, error = await asyncio.to_thread(blocking_get)
+    try:
+        status, error = await asyncio.to_thread(blocking_get)
+    finally:
+        profile_cache.invalidate(username)
     return status, error
 
 
 async def get_stats(username):
-    def blocking_get():
+    def blocking_rank(score):
         conn = sqlite3.connect(database_name)
         c = conn.cursor()
 
-        # Get the user's score
-        c.execute("SELECT score, title, number_of_games, number_of_wins, money, items, stats FROM users WHERE username = ?", (username,))
-        result = c.fetchone()
-        if not result:
-            conn.close()
-            return 0, 'get-stats-fail', {}
-
-        score = result[0]
-        title = result[1]
-        number_of_games = result[2]
-        number_of_wins = result[3]
-        money = result[4]
-        items = json.loads(result[5])
-        try:
-            other_stats = json.loads(result[6]) if result[6] else {}
-        except json.JSONDecodeError:
-            other_stats = {}
-
         # Count users with a higher score (rank = count + 1)
         c.execute("SELECT COUNT(*) FROM users WHERE score > ?", (score,))
         higher_count = c.fetchone()[0]
         conn.close()
 
-        other_stats = DEFAULT_STATS.copy() | other_stats
+        return higher_count
 
-        return 1, None, {"username": username, "title": title, "score": score, "rank": higher_count + 1,
-                         "number_of_games": number_of_games, "number_of_wins": number_of_wins,
-                         "units_destroyed": other_stats['units_destroyed'],
-                         "shortest_game": other_stats['shortest_game'],
-                         "minimal_casualties": other_stats['minimal_casualties'],
-                         "dev_defeated": other_stats['dev_defeated'],
-                         "campaign_completed": other_stats['campaign_completed'], 'money': money, 'items': items}
+    profile = await get_profile(username)
+    if profile is None:
+        return 0, 'get-stats-fail', {}
 
-    return await asyncio.to_thread(blocking_get)
+    score = profile['score']
+    other_stats = profile['stats']
+    higher_count = await asyncio.to_thread(blocking_rank, score)
 
+    return 1, None, {"username": username, "title": profile['title'], "score": score, "rank": higher_count + 1,
+                     "number_of_games": profile['number_of_games'], "number_of_wins": profile['number_of_wins'],
+                     "units_destroyed": other_stats['units_destroyed'],
+                     "shortest_game": other_stats['shortest_game'],
+                     "minimal_casualties": other_stats['minimal_casualties'],
+                     "dev_defeated": other_stats['dev_defeated'],
+                     "campaign_completed": other_stats['campaign_completed'], 'money': profile['money'],
+                     'items': list(profile['items'])}
 
-async def sync_campaign(username, progress):
-    def blocking_sync():
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
 
-        # Fetch current stats
-        c.execute('SELECT stats FROM users WHERE username = ?', (username,))
-        row = c.fetchone()
-        if row is None:
-            conn.close()
-            return 0, 'user-not-found', [], False
-
-        try:
-            stats = json.loads(row[0]) if row[0] else {}
-        except json.JSONDecodeError:
-            stats = {}
-
-        # Merge with defaults to fill missing keys safely
-        stats = DEFAULT_STATS.copy() | stats
-
-        # Merge campaign progress (union of existing and new)
-        existing_progress = set(stats.get('campaign_progress', []))
-        new_progress = set(progress)
-        merged_progress = list(existing_progress | new_progress)
-        stats['campaign_progress'] = merged_progress
-
-        # Set campaign_completed if indicated
-        if len(progress) > 29:
-            campaign_completed = True
-            stats['campaign_completed'] = True
-        else:
-            campaign_completed = False
+# Campaign progress is a bitmask in its own column, bit n set when level n is completed.
+# The progress list in the stats blob is only read once, when the column is added.
 
-        # Write back to DB
-        c.execute('UPDATE users SET stats = ? WHERE username = ?', (json.dumps(stats), username))
-        conn.commit()
-        conn.close()
+def campaign_mask(levels):
+    mask = 0
+    for level in levels:
+        if isinstance(level, int) and not isinstance(level, bool) and 0 <= level < CAMPAIGN_MAX_LEVEL:
+            mask |= 1 << level
+    return mask
 
-        return 1, None, merged_progress, campaign_completed
 
-    return await asyncio.to_thread(blocking_sync)
+def campaign_levels(mask):
+    levels = []
+    while mask:
+        low = mask & -mask
+        levels.append(low.bit_length() - 1)
+        mask ^= low
+    return levels
 
 
-# GAME RELATED
+def init_campaign_mask():
+    conn = sqlite3.connect(database_name)
+    c = conn.cursor()
+    c.execute('PRAGMA table_info(users)')
+    if 'campaign_mask' in [row[1] for row in c.fetchall()]:
+        conn.close()
+        return 0
 
-async def update_elo(score_a, score_b, k=50):
-    def expected_score(r1, r2):
-        return 1 / (1 + 10 ** ((r2 - r1) / 400))
+    c.execute('ALTER TABLE users ADD COLUMN campaign_mask INTEGER DEFAULT 0')
+    c.execute("SELECT rowid, stats FROM users WHERE stats NOT LIKE '%\"campaign_progress\": []%'")
+    converted = 0
+    while True:
+        rows = c.fetchmany(5000)
+        if not rows:
+            break
+        updates = []
+        for rowid, stats in rows:
+            try:
+                mask = campaign_mask(json.loads(stats).get('campaign_progress', []))
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            if mask:
+                updates.append((mask, rowid))
+        conn.executemany('UPDATE users SET campaign_mask = ? WHERE rowid = ?', updates)
+        converted += len(updates)
+    conn.commit()
+    conn.close()
+    return converted
+
+
+async def merge_campaign(username, completed):
+    # Returns the stored mask after adding the newly completed levels, None for unknown users
+    def blocking_merge():
+        conn = sqlite3.connect(database_name)
+        c = conn.cursor()
+        # Read back inside the same transaction, RETURNING would need SQLite 3.35
+        c.execute('UPDATE users SET campaign_mask = campaign_mask | ? WHERE username = ?', (completed, username))
+        c.execute('SELECT campaign_mask FROM users WHERE username = ?', (username,))
+        row = c.fetchone()
+        mask = row[0] if row is not None else None
+
+        # Completion is written into the stats blob once, the first sync that completes the campaign
+        stats_changed = False
+        if mask is not None and bin(mask).count('1') >= CAMPAIGN_LEVELS:
+            c.execute("UPDATE users SET stats = json_set(stats, '$.campaign_completed', json('true')) "
+                      "WHERE username = ? AND NOT coalesce(json_extract(stats, '$.campaign_completed'), 0)", (username,))
+            stats_changed = c.rowcount > 0
+        conn.commit()
+        conn.close()
+        return mask, stats_changed
 
-    expected_a = expected_score(score_a, score_b)
+    # Cached profiles hold the stats blob but not the mask
+    mask, stats_changed = await asyncio.to_thread(blocking_merge)
+    if stats_changed:
+        profile_cache.invalidate(username)
+    return mask
 
-    delta = k * (1 - expected_a)
 
-    return delta
+async def sync_campaign(username, progress):
+    # Whole list in, whole list out, kept for clients without campaign-delta
+    try:
+        mask = await merge_campaign(username, campaign_mask(progress))
+    except Exception as e:
+        log_event('sync-campaign-error', logging.ERROR, username=username, error=str(e))
+        return 0, 'sync-campaign-fail', [], False
+    if mask is None:
+        return 0, 'user-not-found', [], False
+    return 1, None, campaign_levels(mask), bin(mask).count('1') >= CAMPAIGN_LEVELS
 
 
 async def score_game(players, winner, additional_info=None, elo=True):
+    # Returns the score change of every player
     if winner is None:
         elo = False
+    changes = [0 for player in players]
 
     if elo:
         # Get current scores
-        scores = await asyncio.gather(*[get_score(player.username) for player in players])
-        scores = [score for score in scores]
-
-        deltas = [0 for player in players]
-
-        for i in range(len(players)):
-            if i != winner:
-                # Update ELO deltas
-                delta = await update_elo(scores[winner], scores[i])
-                deltas[winner] += delta
-                deltas[i] -= delta
+        profiles = await get_profiles([player.username for player in players])
+        scores = [profiles[player.username]['score'] if player.username in profiles else 0 for player in players]
 
+        changes = rating.elo_changes(scores, winner)
         for i in range(len(scores)):
-            scores[i] = round(scores[i] + deltas[i])
+            scores[i] += changes[i]
 
     # Write updates to DB in a thread
     def blocking_score():
@@ -740,55 +1308,38 @@ async def score_game(players, winner, additional_info=None, elo=True):
         finally:
             conn.close()
 
-    await asyncio.to_thread(blocking_score)
+    try:
+        await asyncio.to_thread(blocking_score)
+    finally:
+        profile_cache.invalidate(*[player.username for player in players])
+    return changes
 
 
 async def get_score(username):
-    def blocking_get():
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
-        c.execute('SELECT score FROM users WHERE username = ?', (username,))
-        result = c.fetchone()
-        conn.close()
-        return result
-
-    score = await asyncio.to_thread(blocking_get)
-    return score[0] if score else 0
+    profile = await get_profile(username)
+    return profile['score'] if profile else 0
 
 
 async def get_titles(usernames):
-    titles = []
-
-    def blocking_get():
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
-
-        for username in usernames:
-            c.execute('SELECT title FROM users WHERE username = ?', (username,))
-            result = c.fetchone()
-            if result:
-                result = result[0]
-                if result is None:
-                    result = ''
-                else:
-                    result = '  ' + result
-            titles.append(result)
-
-        conn.close()
-
-        return titles
-
-    return await asyncio.to_thread(blocking_get)
+    profiles = await get_profiles(usernames)
 
+    titles = []
+    for username in usernames:
+        if username not in profiles:
+            titles.append(None)
+        elif profiles[username]['title'] is None:
+            titles.append('')
+        else:
+            titles.append('  ' + profiles[username]['title'])
 
-async def notify_spectator(spectator, data):
-    status = await send_orjson(spectator.writer, data)
-    if not status:
-        await disconnect(spectator)
+    return titles
 
 
 async def disconnect(player):
-    await remove_online_user(player.username)
+    if player.disconnected:
+        return
+    player.disconnected = True
+    remove_online_user(player.username)
     try:
         player.writer.close()
         await player.writer.wait_closed()
@@ -796,6 +1347,33 @@ async def disconnect(player):
         pass
 
 
+async def ping_sweep(players):
+    async def ping(player):
+        async with ping_semaphore:
+            return await is_connected(player)
+
+    return await asyncio.gather(*[ping(player) for player in players])
+
+
+async def prune_players(players, sweep=False):
+    # Players whose connection is already known to be lost cost no I/O
+    for i in range(len(players) - 1, -1, -1):
+        if not players[i].connected:
+            await disconnect(players[i])
+            players.pop(i)
+
+    if sweep and players:
+        alive = await ping_sweep(players)
+        for i in range(len(players) - 1, -1, -1):
+            if not alive[i]:
+                await disconnect(players[i])
+                players.pop(i)
+
+
+def sweep_due(last_sweep):
+    return PING_SWEEP_INTERVAL and time.monotonic() - last_sweep >= PING_SWEEP_INTERVAL
+
+
 async def is_connected(player):
     try:
         if await send_orjson(player.writer, orjson.dumps("check")) == 0:
@@ -809,10 +1387,13 @@ async def is_connected(player):
         return False
 
 
-async def read_orjson(reader):
+async def read_orjson(reader, max_size=MAX_REQUEST_FRAME, timeout=10):
     try:
-        length_bytes = await asyncio.wait_for(reader.readexactly(4), timeout=10)
+        length_bytes = await asyncio.wait_for(reader.readexactly(4), timeout=timeout)
         length = struct.unpack('>I', length_bytes)[0]
+        if length > max_size:
+            admission_stats['rejected-frame'] += 1
+            return 0
         data = await asyncio.wait_for(reader.readexactly(length), timeout=1)
         return data
     except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError, Exception) as e:
@@ -823,6 +1404,9 @@ async def receive_ingame(reader):
     try:
         length_bytes = await asyncio.wait_for(reader.readexactly(4), timeout=0.8)
         length = struct.unpack('>I', length_bytes)[0]
+        if length > MAX_INGAME_FRAME:
+            admission_stats['rejected-frame'] += 1
+            return {'end-game': 'connection-lost'}
 
         data = await asyncio.wait_for(reader.readexactly(length), timeout=0.5)
         return orjson.loads(data)
@@ -848,12 +1432,808 @@ async def send_orjson(writer, message):
         return 0
 
 
-async def game_session(mode, players, custom_map=None, score=True, spectators=None):
+# GAME SNAPSHOTS
+
+def snapshot_game(game_id, mode, players, map_final, tick, state, score):
+    # Runs inside the tick, only records the latest state for the writer task
+    start = time.perf_counter()
+    pending_snapshots[game_id] = (game_id, mode, orjson.dumps([player.username for player in players]), map_final,
+                                  tick, state, int(score), time.time(), os.getpid())
+    snapshot_stats['captures'] += 1
+    snapshot_stats['capture-seconds'] += time.perf_counter() - start
+
+
+def forget_snapshot(game_id):
+    pending_snapshots[game_id] = None
+
+
+def snapshot_report():
+    captures = snapshot_stats['captures']
+    capture_time = snapshot_stats['capture-seconds'] / captures if captures else 0.0
+    flushes = snapshot_stats['flushes']
+    return {'captures': captures, 'capture_us': capture_time * 1e6,
+            'tick_budget_share': capture_time / TICK_SECONDS,
+            'flushes': flushes, 'flush_ms': snapshot_stats['flush-seconds'] / flushes * 1e3 if flushes else 0.0,
+            'rows_written': snapshot_stats['rows']}
+
+
+def init_snapshots():
+    conn = sqlite3.connect(SNAPSHOT_DB)
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS game_snapshots (
+            game_id TEXT PRIMARY KEY,
+            mode TEXT NOT NULL,
+            players TEXT NOT NULL,
+            map INTEGER,
+            tick INTEGER,
+            state BLOB,
+            score INTEGER,
+            updated REAL,
+            owner INTEGER
+        )
+    ''')
+    # Rows written before the owner column are treated as orphans
+    c.execute('PRAGMA table_info(game_snapshots)')
+    if 'owner' not in [row[1] for row in c.fetchall()]:
+        c.execute('ALTER TABLE game_snapshots ADD COLUMN owner INTEGER')
+    conn.commit()
+    conn.close()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+async def snapshot_writer():
+    while True:
+        await asyncio.sleep(SNAPSHOT_FLUSH_INTERVAL)
+        if not pending_snapshots:
+            continue
+
+        batch = pending_snapshots.copy()
+        pending_snapshots.clear()
+
+        def blocking_flush():
+            conn = sqlite3.connect(SNAPSHOT_DB)
+            c = conn.cursor()
+            c.executemany('INSERT OR REPLACE INTO game_snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          [row for row in batch.values() if row is not None])
+            c.executemany('DELETE FROM game_snapshots WHERE game_id = ?',
+                          [(game_id,) for game_id, row in batch.items() if row is None])
+            conn.commit()
+            conn.close()
+
+        start = time.perf_counter()
+        snapshot_stats['in-flight'] = len(batch)
+        try:
+            await asyncio.to_thread(blocking_flush)
+        except Exception as e:
+            log_event('snapshot-error', logging.ERROR, error=str(e))
+        snapshot_stats['in-flight'] = 0
+        snapshot_stats['flushes'] += 1
+        snapshot_stats['flush-seconds'] += time.perf_counter() - start
+        snapshot_stats['rows'] += len(batch)
+
+
+async def load_orphaned_games():
+    def blocking_load():
+        init_snapshots()
+        conn = sqlite3.connect(SNAPSHOT_DB)
+        c = conn.cursor()
+        c.execute('SELECT game_id, mode, players, map, tick, state, score, owner FROM game_snapshots')
+        rows = c.fetchall()
+        conn.close()
+        return rows
+
+    # After a hand-off the previous process is still draining its games and settles them itself,
+    # only the rows of processes that are gone are orphans
+    handed_off = bool(os.getenv('WOD_LISTEN_FDS'))
+    for game_id, mode, players, map_final, tick, state, score, owner in await asyncio.to_thread(blocking_load):
+        if handed_off and owner and owner != os.getpid() and process_alive(owner):
+            continue
+        orphaned_games.set(game_id, {'game_id': game_id, 'mode': mode, 'players': orjson.loads(players), 'map': map_final,
+                                     'tick': tick, 'state': orjson.loads(state) if state else {}, 'score': bool(score),
+                                     'joined': {}})
+
+    if len(orphaned_games):
+        log_event('resume-available', games=len(orphaned_games), window=RESUME_WINDOW)
+        asyncio.create_task(settle_orphaned_games())
+
+
+async def resume_player(game_id, player):
+    orphan = orphaned_games.get(game_id)
+    if orphan is None or player.username not in orphan['players']:
+        return 0
+
+    orphan['joined'][player.username] = player
+    if len(orphan['joined']) == len(orphan['players']):
+        orphaned_games.pop(game_id)
+        players = [orphan['joined'][username] for username in orphan['players']]
+        start_game(orphan['mode'], players, score=orphan['score'], resume=orphan)
+    return 1
+
+
+async def settle_orphaned_games():
+    await asyncio.sleep(RESUME_WINDOW)
+
+    for orphan in orphaned_games.values():
+        orphaned_games.pop(orphan['game_id'])
+
+        # Not everybody came back, the game counts as played without a winner
+        for player in orphan['joined'].values():
+            await send_orjson(player.writer, orjson.dumps({'end-game': -1}))
+            await disconnect(player)
+        players = [Player(username, None, None, 0) for username in orphan['players']]
+        changes = await score_game(players, None, elo=False)
+        record_match(orphan['game_id'], orphan['mode'], players, None, None, True, False, changes, None, orphan['tick'])
+        forget_snapshot(orphan['game_id'])
+        log_event('resume-settled', game_id=orphan['game_id'], mode=orphan['mode'])
+
+
+# MATCH HISTORY
+# Finished games are queued as result events and written by one task, many per transaction.
+
+match_stats = Counter()
+
+
+def init_matches():
+    conn = sqlite3.connect(database_name)
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS matches (
+            game_id TEXT PRIMARY KEY,
+            mode TEXT NOT NULL,
+            winner TEXT NULL,
+            started INTEGER,
+            duration INTEGER,
+            ticks INTEGER,
+            counted INTEGER,
+            rated INTEGER,
+            casualties TEXT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS match_players (
+            game_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            seat INTEGER,
+            elo_delta INTEGER DEFAULT 0,
+            started INTEGER,
+            PRIMARY KEY (game_id, username)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS matches_started ON matches (started)')
+    c.execute('CREATE INDEX IF NOT EXISTS match_players_history ON match_players (username, started)')
+
+    # Matches recorded before the rated column count as rated when somebody's rating changed
+    c.execute('PRAGMA table_info(matches)')
+    if 'rated' not in [row[1] for row in c.fetchall()]:
+        c.execute('ALTER TABLE matches ADD COLUMN rated INTEGER')
+        c.execute('''
+            UPDATE matches SET rated = counted AND winner IS NOT NULL AND EXISTS (
+                SELECT 1 FROM match_players p WHERE p.game_id = matches.game_id AND p.elo_delta != 0)
+        ''')
+    conn.commit()
+    conn.close()
+
+
+def record_match(game_id, mode, players, winner, stats, counted, rated, changes, started, ticks):
+    # Never blocks, the row is written by match_writer
+    now = time.time()
+    started = int(started if started is not None else now)
+    casualties = stats.get('casualties') if isinstance(stats, dict) else None
+    match = (game_id, mode, players[winner].username if winner is not None else None, started, int(now - started), ticks,
+             int(counted), int(bool(rated and counted and winner is not None)), orjson.dumps(casualties).decode() if casualties is not None else None)
+    seats = [(game_id, players[i].username, i, changes[i] if changes else 0, started) for i in range(len(players))]
+    match_results.put_nowait((match, seats))
+
+
+async def match_writer():
+    while True:
+        batch = [await match_results.get()]
+        # Let results that finish close together share a transaction
+        await asyncio.sleep(MATCH_FLUSH_INTERVAL)
+        while len(batch) < MATCH_BATCH and not match_results.empty():
+            batch.append(match_results.get_nowait())
+
+        def blocking_write():
+            conn = sqlite3.connect(database_name)
+            c = conn.cursor()
+            # Named columns, a migrated table has rated after casualties
+            c.executemany('''
+                INSERT OR REPLACE INTO matches (game_id, mode, winner, started, duration, ticks, counted, rated, casualties)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [match for match, seats in batch])
+            c.executemany('INSERT OR REPLACE INTO match_players VALUES (?, ?, ?, ?, ?)',
+                          [seat for match, seats in batch for seat in seats])
+            conn.commit()
+            conn.close()
+
+        match_stats['in-flight'] = len(batch)
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(blocking_write)
+            match_stats['written'] += len(batch)
+        except Exception as e:
+            match_stats['errors'] += 1
+            log_event('match-write-error', logging.ERROR, matches=len(batch), error=str(e))
+        match_stats['in-flight'] = 0
+        match_stats['batches'] += 1
+        match_stats['write-seconds'] += time.perf_counter() - start
+
+
+async def get_match_history(username, before=None, limit=MATCH_HISTORY_LIMIT):
+    def blocking_history():
+        conn = sqlite3.connect(database_name)
+        c = conn.cursor()
+        c.execute('''
+            SELECT m.game_id, m.mode, m.winner, m.started, m.duration, m.ticks, m.counted, m.casualties, p.seat, p.elo_delta
+            FROM match_players p JOIN matches m ON m.game_id = p.game_id
+            WHERE p.username = ? AND p.started < ?
+            ORDER BY p.started DESC LIMIT ?
+        ''', (username, before if before is not None else 2 ** 62, limit))
+        rows = c.fetchall()
+
+        seats = {}
+        if rows:
+            c.execute(f'SELECT game_id, username FROM match_players WHERE game_id IN ({",".join("?" * len(rows))}) ORDER BY seat',
+                      [row[0] for row in rows])
+            for game_id, player in c.fetchall():
+                seats.setdefault(game_id, []).append(player)
+        conn.close()
+        return rows, seats
+
+    rows, seats = await asyncio.to_thread(blocking_history)
+    return [{'game_id': game_id, 'mode': mode, 'winner': winner, 'started': started, 'duration': duration, 'ticks': ticks,
+             'counted': bool(counted), 'casualties': orjson.loads(casualties) if casualties else None,
+             'players': seats.get(game_id, []), 'color': seat, 'elo_delta': elo_delta}
+            for game_id, mode, winner, started, duration, ticks, counted, casualties, seat, elo_delta in rows]
+
+
+# REPLAYS
+# A replay file is a 5 byte header (magic and codec) followed by records, each a 4 byte
+# length and a compressed frame. The first record is the game's start info. The .idx file
+# next to it holds one (tick, offset) pair per frame for seeking.
+
+REPLAY_MAGIC = b'WODR'
+REPLAY_INDEX = struct.Struct('>IQ')
+
+
+def replay_paths(game_id):
+    # Game ids are hex, anything else could escape the replay directory
+    if not game_id or any(c not in '0123456789abcdef' for c in game_id):
+        return None
+    return os.path.join(REPLAY_DIR, f'{game_id}.replay'), os.path.join(REPLAY_DIR, f'{game_id}.idx')
+
+
+def replay_codec(codec):
+    if codec == b's':
+        if zstandard is None:
+            return None
+        return zstandard.ZstdDecompressor().decompress
+    return zlib.decompress
+
+
+class ReplayWriter:
+    def __init__(self):
+        self.jobs = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='replay-writer', daemon=True)
+        self.thread.start()
+
+    # Called from the event loop, only hands the frame over to the writer thread
+    def open(self, game_id, header, append=False):
+        if self.thread is not None:
+            self.jobs.put(('append' if append else 'open', game_id, 0, header))
+
+    def frame(self, game_id, tick, data):
+        if self.thread is not None:
+            self.jobs.put(('frame', game_id, tick, data))
+
+    def close(self, game_id):
+        if self.thread is not None:
+            self.jobs.put(('close', game_id, 0, None))
+
+    def run(self):
+        if zstandard is not None:
+            codec, compress = b's', zstandard.ZstdCompressor(level=3).compress
+        else:
+            codec, compress = b'z', lambda data: zlib.compress(data, 6)
+        files = {}
+
+        while True:
+            action, game_id, tick, data = self.jobs.get()
+            try:
+                if action == 'append' and os.path.exists(replay_paths(game_id)[0]):
+                    # A resumed game continues its replay
+                    replay_path, index_path = replay_paths(game_id)
+                    files[game_id] = (open(replay_path, 'ab'), open(index_path, 'ab'))
+                elif action in ('open', 'append'):
+                    replay_path, index_path = replay_paths(game_id)
+                    replay = open(replay_path, 'wb')
+                    replay.write(REPLAY_MAGIC + codec)
+                    files[game_id] = (replay, open(index_path, 'wb'))
+                    data = compress(data)
+                    replay.write(struct.pack('>I', len(data)) + data)
+                elif action == 'frame' and game_id in files:
+                    replay, index = files[game_id]
+                    offset = replay.tell()
+                    data = compress(data)
+                    replay.write(struct.pack('>I', len(data)) + data)
+                    index.write(REPLAY_INDEX.pack(tick, offset))
+                elif action == 'close' and game_id in files:
+                    replay, index = files.pop(game_id)
+                    replay.close()
+                    index.close()
+            except Exception as e:
+                log_event('replay-error', logging.ERROR, game_id=game_id, error=str(e))
+
+
+replay_writer = ReplayWriter()
+
+
+def prune_replays(live):
+    # Blocking. Removes replays older than REPLAY_MAX_AGE and all but the newest REPLAY_KEEP,
+    # except those of the games in live. Returns how many were removed
+    try:
+        names = os.listdir(REPLAY_DIR)
+    except FileNotFoundError:
+        return 0
+
+    replays = []
+    for name in names:
+        if name.endswith('.replay') and replay_paths(name[:-len('.replay')]) is not None:
+            try:
+                replays.append((os.path.getmtime(os.path.join(REPLAY_DIR, name)), name[:-len('.replay')]))
+            except FileNotFoundError:
+                pass
+
+    # Newest first
+    replays.sort(reverse=True)
+    oldest = time.time() - REPLAY_MAX_AGE
+    removed = 0
+    for i, (modified, game_id) in enumerate(replays):
+        if (i >= REPLAY_KEEP or modified < oldest) and game_id not in live:
+            for path in replay_paths(game_id):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            removed += 1
+    return removed
+
+
+def read_replay(game_id, from_tick=0, limit=100):
+    # Blocking, returns (start info, [(tick, frame)...], next tick) or None
+    paths = replay_paths(game_id)
+    if paths is None or not os.path.exists(paths[0]):
+        return None
+    replay_path, index_path = paths
+
+    with open(index_path, 'rb') as index:
+        data = index.read()
+        entries = list(REPLAY_INDEX.iter_unpack(data[:len(data) - len(data) % REPLAY_INDEX.size]))
+    ticks = [tick for tick, offset in entries]
+    position = bisect.bisect_left(ticks, from_tick)
+
+    with open(replay_path, 'rb') as replay:
+        magic = replay.read(5)
+        decompress = replay_codec(magic[4:5])
+        if magic[:4] != REPLAY_MAGIC or decompress is None:
+            return None
+        length = struct.unpack('>I', replay.read(4))[0]
+        start_info = decompress(replay.read(length))
+
+        frames = []
+        for tick, offset in entries[position:position + limit]:
+            replay.seek(offset)
+            header = replay.read(4)
+            if len(header) < 4:
+                # Cut short by a crash
+                return start_info, frames, None
+            length = struct.unpack('>I', header)[0]
+            data = replay.read(length)
+            if len(data) < length:
+                return start_info, frames, None
+            frames.append((tick, decompress(data)))
+
+    next_tick = ticks[position + limit] if position + limit < len(ticks) else None
+    return start_info, frames, next_tick
+
+
+async def stream_replay(writer, game_id, from_tick=0, speed=1):
+    # Only finished games, a live game's file is still being written
+    replay = None if game_id in live_games else await asyncio.to_thread(read_replay, game_id, from_tick)
+    if replay is None:
+        await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'replay-not-found'}))
+        return
+
+    start_info, frames, next_tick = replay
+    await send_orjson(writer, orjson.dumps({'status': 1}))
+    if not await send_orjson(writer, start_info):
+        return
+
+    delay = TICK_SECONDS / max(speed, 0.1)
+    while True:
+        for tick, frame in frames:
+            if not await send_orjson(writer, frame):
+                return
+            await asyncio.sleep(delay)
+
+        if next_tick is None:
+            break
+        # Frames are read in chunks so a long replay is never fully in memory
+        _, frames, next_tick = await asyncio.to_thread(read_replay, game_id, next_tick)
+
+    await send_orjson(writer, orjson.dumps({'end-game': -1}))
+
+
+# SPECTATORS
+
+class Spectator:
+    def __init__(self, player, relay):
+        self.player = player
+        self.relay = relay
+        self.frames = deque()
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.skipped = 0
+        self.task = asyncio.create_task(self.run())
+
+    def push(self, frame):
+        if len(self.frames) >= SPECTATOR_BUFFER:
+            # Too far behind, jump straight to the newest state
+            self.frames.clear()
+            self.skipped += 1
+        self.frames.append(frame)
+        self.wakeup.set()
+
+    def finish(self, frame):
+        self.frames.append(frame)
+        self.closing = True
+        self.wakeup.set()
+
+    async def run(self):
+        try:
+            if not await send_orjson(self.player.writer, self.relay.start_info):
+                return
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.frames:
+                    if not await send_orjson(self.player.writer, self.frames.popleft()):
+                        return
+                if self.closing:
+                    return
+        finally:
+            self.relay.spectators.pop(self.player, None)
+            await disconnect(self.player)
+
+
+class SpectatorRelay:
+    def __init__(self, start_info, delay=SPECTATOR_DELAY):
+        self.start_info = start_info
+        self.delay = delay
+        self.delayed = deque()
+        self.spectators = {}
+
+    def add(self, player):
+        unwatch_waiting(player)
+        self.spectators[player] = Spectator(player, self)
+
+    def publish(self, frame):
+        if self.delay:
+            self.delayed.append(frame)
+            if len(self.delayed) <= self.delay:
+                return
+            frame = self.delayed.popleft()
+
+        for spectator in self.spectators.values():
+            spectator.push(frame)
+
+    def close(self, frame):
+        for spectator in list(self.spectators.values()):
+            for delayed in self.delayed:
+                spectator.push(delayed)
+            spectator.finish(frame)
+        self.delayed.clear()
+
+
+# TICK DRIVER
+# One timer wheel drives every running game. Each game gets the least loaded of TICK_SLOTS
+# phases, so games started together don't all tick at the same moment.
+
+class TickDriver:
+    def __init__(self, slots):
+        self.slots = slots
+        self.slot_seconds = TICK_SECONDS / slots
+        self.games = {}  # game_id -> [slot, time of last release]
+        self.load = [0] * slots
+        self.work = [0.0] * slots  # seconds the games of a slot spent computing ticks, never reset
+        self.waiters = [[] for _ in range(slots)]
+        self.late = 0
+        self.lag = 0.0
+
+    def add(self, game_id):
+        slot = self.load.index(min(self.load))
+        self.load[slot] += 1
+        self.games[game_id] = [slot, time.monotonic()]
+
+    def remove(self, game_id):
+        entry = self.games.pop(game_id, None)
+        if entry is not None:
+            self.load[entry[0]] -= 1
+
+    def record(self, game_id, seconds):
+        # Only the game's own processing, waiting for the players' input and sending is left out
+        self.work[self.games[game_id][0]] += seconds
+
+    async def next_tick(self, game_id):
+        entry = self.games[game_id]
+        slot, released = entry
+        now = time.monotonic()
+
+        # A tick that took the whole period already is late, it doesn't wait for its phase again
+        if now - released >= TICK_SECONDS:
+            self.late += 1
+            entry[1] = now
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[slot].append(waiter)
+        entry[1] = await waiter
+
+    async def run(self):
+        slot = 0
+        due = time.monotonic()
+        while True:
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.monotonic()
+            self.lag = now - due
+
+            waiters, self.waiters[slot] = self.waiters[slot], []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(now)
+
+            slot = (slot + 1) % self.slots
+            due += self.slot_seconds
+            if now - due > TICK_SECONDS:
+                # Fell more than a period behind, don't fire the missed slots in a burst
+                due = now
+
+    def report(self):
+        # Work is exported as counters, so any number of scrapers can take rates over their own intervals
+        report = {
+            'games': len(self.games),
+            'slot_games_max': max(self.load),
+            'slot_games_min': min(self.load),
+            'late': self.late,
+            'lag_seconds': self.lag,
+        }
+        for slot in range(self.slots):
+            report[f'slot_work_seconds_total{{slot="{slot}"}}'] = self.work[slot]
+        return report
+
+
+tick_driver = TickDriver(TICK_SLOTS)
+
+
+# RUNNING GAMES
+
+class LiveGame:
+    def __init__(self, game_id, mode, players, map_final, tick):
+        self.game_id = game_id
+        self.mode = mode
+        self.players = players
+        self.map = map_final
+        self.tick = tick
+        self.usernames = None
+        self.last_state = b'{}'
+        self.relay = None
+
+        # A player can only get back into the game with their own token
+        self.tokens = {player.username: os.urandom(16).hex() for player in players}
+        self.lost = {}
+
+    def start_info(self, i):
+        return {'color': i, 'map': str(self.map), 'players': self.usernames, 'game_id': self.game_id,
+                'token': self.tokens[self.players[i].username]}
+
+    async def receive(self, player):
+        lost_at = self.lost.get(player.username)
+        if lost_at is not None:
+            if time.monotonic() - lost_at > RECONNECT_GRACE:
+                return {'end-game': 'connection-lost'}
+            return {}
+
+        generation = player.generation
+        message = await receive_ingame(player.reader)
+        if player.generation != generation:
+            # The player reconnected while this read was pending
+            return {}
+
+        if message.get('end-game') == 'connection-lost' and RECONNECT_GRACE:
+            self.lost[player.username] = time.monotonic()
+            log_event('player-lost', game_id=self.game_id, mode=self.mode, username=player.username, grace=RECONNECT_GRACE)
+            return {}
+        return message
+
+    def reattach(self, username, token, reader, writer):
+        if token is None or self.tokens.get(username) != token:
+            return None
+
+        for i in range(len(self.players)):
+            player = self.players[i]
+            if player.username != username or player.disconnected:
+                continue
+
+            # Status and catch-up are written before the next tick frame can reach the new connection
+            catch_up = self.start_info(i) | {'resume': orjson.loads(self.last_state), 'tick': self.tick}
+            status = orjson.dumps({'status': 1})
+            catch_up = orjson.dumps(catch_up)
+            writer.write(struct.pack('>I', len(status)) + status + struct.pack('>I', len(catch_up)) + catch_up)
+
+            old_writer = player.writer
+            player.generation += 1
+            player.reader = reader
+            player.writer = writer
+            self.lost.pop(username, None)
+            try:
+                old_writer.close()
+            except Exception as e:
+                pass
+
+            return player
+
+        return None
+
+
+# END OF GAME
+# Every participant is asked at once and the replies share a single deadline. The result
+# comes from a rule table, scoring runs afterwards in its own task.
+
+def end_kind(message):
+    if 'end-game' not in message:
+        return 'playing'
+    if message['end-game'] == 0 or message['end-game'] == 1:
+        return 'claim'
+    # Surrender, connection lost or anything else the game doesn't know
+    return 'quit'
+
+
+# (first player, second player) -> how a 1v1 is settled
+END_RULES_1V1 = {
+    ('claim', 'claim'): 'compare',  # both saw the end, it counts if they agree
+    ('claim', 'playing'): 'confirm',  # the other player has to confirm the claim
+    ('playing', 'claim'): 'confirm',
+    ('quit', 'playing'): 'forfeit',  # whoever left loses
+    ('quit', 'claim'): 'forfeit',
+    ('quit', 'quit'): 'forfeit',
+    ('playing', 'quit'): 'forfeit',
+    ('claim', 'quit'): 'forfeit',
+}
+
+
+async def confirm_end(game, notices, replies_from):
+    # Returns {username: reply} of those who answered before the deadline
+    await asyncio.gather(*[send_orjson(player.writer, orjson.dumps(notice)) for player, notice in notices])
+
+    reads = {}
+    for player in replies_from:
+        if player.connected and player.username not in game.lost:
+            read = read_orjson(player.reader, max_size=MAX_INGAME_FRAME, timeout=SETTLE_TIMEOUT)
+            reads[asyncio.create_task(read)] = player.username
+    if not reads:
+        return {}
+
+    done, pending = await asyncio.wait(reads, timeout=SETTLE_TIMEOUT)
+    for task in pending:
+        task.cancel()
+
+    replies = {}
+    for task in done:
+        try:
+            reply = orjson.loads(task.result()) if task.result() else None
+        except orjson.JSONDecodeError:
+            reply = None
+        if isinstance(reply, dict):
+            replies[reads[task]] = reply
+    return replies
+
+
+async def settle_1v1(game, rule, data):
+    # Returns (counted, winner, stats)
+    players = game.players
+    kinds = [end_kind(message) for message in data]
+
+    if rule == 'forfeit':
+        loser = kinds.index('quit')
+        winner = 1 - loser
+        if kinds[winner] == 'playing':
+            await confirm_end(game, [(players[winner], {'end-game': 1})], [])
+        return True, winner, data[winner].get('stats') or data[loser].get('stats')
+
+    if rule == 'compare':
+        claim = data[0]['end-game']
+        if claim != data[1]['end-game']:
+            return False, None, None
+        return True, claim, data[claim].get('stats')
+
+    claimant = kinds.index('claim')
+    other = players[1 - claimant]
+    claim = data[claimant]['end-game']
+    replies = await confirm_end(game, [(other, {'end-game': 1})], [other])
+    reply = replies.get(other.username)
+    if reply is None:
+        # No answer, the claimant wins
+        return True, claimant, data[claimant].get('stats')
+    if reply.get('end-game') != claim:
+        return False, None, None
+    return True, claim, data[claimant].get('stats')
+
+
+async def settle_group(game, active_players, claims):
+    if len(active_players) < 2:
+        # Not enough players left, the last one standing wins
+        if not active_players:
+            return True, None, None
+        last = active_players[0]
+        replies = await confirm_end(game, [(last, {'end-game': 1})], [last])
+        return True, game.players.index(last), replies.get(last.username, {}).get('stats')
+
+    message = claims[-1]
+    await confirm_end(game, [(player, {'end-game': -1}) for player in active_players], [])
+    winner = message['end-game']
+    if not isinstance(winner, int) or not 0 <= winner < len(game.players):
+        winner = None
+    return True, winner, message.get('stats')
+
+
+async def settle_peace(game, active_players):
+    replies = await confirm_end(game, [(player, {'end-game': 0.5}) for player in active_players], active_players)
+    stats = next((reply['stats'] for reply in replies.values() if 'stats' in reply), None)
+    return True, None, stats
+
+
+async def score_settled(game, winner, stats, counted, elo, started):
+    changes = None
+    if counted:
+        try:
+            changes = await score_game(game.players, winner, additional_info=stats, elo=elo)
+        except Exception as e:
+            log_event('score-error', logging.ERROR, game_id=game.game_id, error=str(e))
+    record_match(game.game_id, game.mode, game.players, winner, stats, counted, elo and changes is not None, changes, started,
+                 game.tick)
+
+
+async def game_session(mode, players, custom_map=None, score=True, spectators=None, resume=None):
     active_players = []
     spectators = spectators or []
+    game = None
+    game_id = resume['game_id'] if resume else os.urandom(8).hex()
+    tick = resume['tick'] if resume else 0
+
+    # From here on, losing a connection is handled by the game loop
+    for player in players + spectators:
+        unwatch_waiting(player)
 
     try:
-        if custom_map:
+        if resume:
+            map_final = resume['map']
+        elif custom_map:
             map_final = 0
         else:
             if mode == '1v1':
@@ -867,168 +2247,63 @@ async def game_session(mode, players, custom_map=None, score=True, spectators=No
 
         peace_count = 0
         peace_timer = 0
+        settlement = None
+        peace = False
 
-        random.shuffle(players)
+        if not resume:
+            random.shuffle(players)
         active_players = [player for player in players]
 
         titles = await get_titles([player.username for player in players])
         usernames = [[f'{players[i].username}{titles[i]}'] for i in range(len(players))]
 
+        game = LiveGame(game_id, mode, players, map_final, tick)
+        game.usernames = usernames
+        live_games.set(game_id, game)
+        if RECORD_REPLAYS:
+            replay_writer.open(game_id, orjson.dumps({'color': None, 'map': str(map_final), 'players': usernames, 'mode': mode}),
+                               append=bool(resume))
+
         for i in range(len(players)):
-            await send_orjson(players[i].writer, orjson.dumps({'color': i, 'map': str(map_final), 'players': usernames}))
+            start_info = game.start_info(i)
+            if resume:
+                start_info |= {'resume': resume['state'], 'tick': tick}
+            await send_orjson(players[i].writer, orjson.dumps(start_info))
 
+        game.relay = SpectatorRelay(orjson.dumps({'color': None, 'map': str(map_final), 'players': usernames}))
         for spectator in spectators:
-            asyncio.create_task(send_orjson(spectator.writer, orjson.dumps({'color': None, 'map': str(map_final), 'players': usernames})))
+            game.relay.add(spectator)
 
-        print(f"[GAME] {mode} started: {[player.username for player in players]}")
+        log_event('game-start', game_id=game_id, mode=mode, players=[player.username for player in players])
+        tick_driver.add(game_id)
+        started = time.time()
         await asyncio.sleep(1)
 
         while True:
-            start_time = time.monotonic()
+            await tick_driver.next_tick(game_id)
 
-            data = await asyncio.gather(*[receive_ingame(player.reader) for player in active_players])
+            data = await asyncio.gather(*[game.receive(player) for player in active_players])
+            work_start = time.perf_counter()
             data = [element for element in data]
 
             # Check for end
             if mode == '1v1':
-                message1, message2 = data
-                if 'end-game' in message1 or 'end-game' in message2:
-                    # Notify spectators
-                    for spectator in spectators:
-                        asyncio.create_task(send_orjson(spectator.writer, orjson.dumps({'end-game': -1})))
-
-                    # Check win conditions
-                    if 'end-game' in message1 and 'end-game' in message2:
-                        if message1['end-game'] == message2['end-game'] == 0:
-                            await score_game(players, 0, additional_info=message1['stats'], elo=score)
-                            print(f'[GAME END] Winner: {players[0].username}')
-                            break
-
-                        if message1['end-game'] == message2['end-game'] == 1:
-                            await score_game(players, 1, additional_info=message2['stats'], elo=score)
-                            print(f'[GAME END] Winner: {players[1].username}')
-                            break
-
-                        if message1['end-game'] == 'connection-lost' or message1['end-game'] == 'surrender':
-                            await score_game(players, 1, additional_info=message2['stats'] if 'stats' in message2 else None, elo=score)
-                            print(f'[GAME END] Winner: {players[1].username}')
-                            break
-
-                        if message2['end-game'] == 'connection-lost' or message2['end-game'] == 'surrender':
-                            await score_game(players, 0, additional_info=message1['stats'] if 'stats' in message1 else None, elo=score)
-                            print(f'[GAME END] Winner: {players[0].username}')
-                            break
-
-                        print(f'[GAME END] Winner: None')
-
-                    if 'end-game' in message1:
-                        if message1['end-game'] == 0 or message1['end-game'] == 1:
-                            await send_orjson(players[1].writer, orjson.dumps({'end-game': 1}))
-                            response = await read_orjson(players[1].reader)
-                            if not response:
-                                await score_game(players, 0, additional_info=message1['stats'], elo=score)
-                                print(f'[GAME END] Winner: {players[0].username}')
-                                break
-
-                            response = orjson.loads(response)
-                            if response['end-game'] == message1['end-game']:
-                                if response['end-game'] == 0:
-                                    await score_game(players, 0, additional_info=message1['stats'], elo=score)
-                                    print(f'[GAME END] Winner: {players[0].username}')
-
-                                else:
-                                    await score_game(players, 1, additional_info=message1['stats'], elo=score)
-                                    print(f'[GAME END] Winner: {players[1].username}')
-
-                                break
-
-                            print(f'[GAME END] Winner: None')
-                            break
-
-                        await send_orjson(players[1].writer, orjson.dumps({'end-game': 1}))
-                        await score_game(players, 1, additional_info=message1['stats'], elo=score)
-                        print(f'[GAME END] Winner: {players[1].username}')
-                        break
-
-                if 'end-game' in message2:
-                    if message2['end-game'] == 0 or message2['end-game'] == 1:
-                        await send_orjson(players[0].writer, orjson.dumps({'end-game': 1}))
-                        response = await read_orjson(players[0].reader)
-                        if not response:
-                            await score_game(players, 1, additional_info=message2['stats'], elo=score)
-                            print(f'[GAME END] Winner: {players[1].username}')
-                            break
-
-                        response = orjson.loads(response)
-                        if response['end-game'] == message2['end-game']:
-                            if response['end-game'] == 0:
-                                await score_game(players, 0, additional_info=message2['stats'], elo=score)
-                                print(f'[GAME END] Winner: {players[0].username}')
-
-                            else:
-                                await score_game(players, 1, additional_info=message2['stats'], elo=score)
-                                print(f'[GAME END] Winner: {players[1].username}')
-
-                            break
-
-                        print(f'[GAME END] Winner: None')
-                        break
-
-                    await send_orjson(players[0].writer, orjson.dumps({'end-game': 1}))
-                    await score_game(players, 0, additional_info=message2['stats'], elo=score)
-                    print(f'[GAME END] Winner: {players[0].username}')
+                rule = END_RULES_1V1.get((end_kind(data[0]), end_kind(data[1])))
+                if rule is not None:
+                    settlement = await settle_1v1(game, rule, data)
                     break
 
             else:
-                end_game = False
-                winner = None
-
-                # Count active players
-                count = 0
+                # Players who left are out of the game
                 for i in range(len(data) - 1, -1, -1):
-                    if 'end-game' in data[i]:
-                        if data[i]['end-game'] == 'connection-lost' or data[i]['end-game'] == 'surrender':
-                            await disconnect(active_players[i])
-                            active_players.pop(i)
-                            data.pop(i)
-                    else:
-                        count += 1
-
-                # Game ended because not enough players active
-                if count < 2:
-                    end_game = True
-                    if count == 0:
-                        winner = None
-                    else:
-                        winner = players.index(active_players[0])
-
-                    await send_orjson(active_players[0].writer, orjson.dumps({'end-game': 1}))
-                    response = await read_orjson(active_players[0].reader)
-                    if response:
-                        await score_game(players, winner, additional_info=response['stats'], elo=score)
-                    else:
-                        await score_game(players, winner, elo=score)
-
-                else:
-                    # Check if someone has won
-                    message = None
-                    for i in range(len(data)):
-                        if 'end-game' in data[i]:
-                            message = data[i]
-                            end_game = True
-
-                    if end_game:
-                        for player in active_players:
-                            await send_orjson(player.writer, orjson.dumps({'end-game': -1}))
-
-                        await score_game(players, message['end-game'], additional_info=message['stats'], elo=score)
-
-                if end_game:
-                    # Notify spectators
-                    for spectator in spectators:
-                        asyncio.create_task(notify_spectator(spectator, orjson.dumps({'end-game': -1})))
-
-                    print(f"[GAME END] v34 Winner:{winner}")
+                    if end_kind(data[i]) == 'quit':
+                        await disconnect(active_players[i])
+                        active_players.pop(i)
+                        data.pop(i)
+
+                claims = [message for message in data if 'end-game' in message]
+                if len(active_players) < 2 or claims:
+                    settlement = await settle_group(game, active_players, claims)
                     break
 
             # Check for peace
@@ -1038,17 +2313,8 @@ async def game_session(mode, players, custom_map=None, score=True, spectators=No
                     peace_timer = 20
 
             if peace_count >= len(active_players):
-                for player in active_players:
-                    await send_orjson(player.writer, orjson.dumps({'end-game': 0.5}))
-
-                response = await read_orjson(active_players[0].reader)
-
-                await score_game(players, None, additional_info=response['stats'], elo=score)
-
-                # Notify spectators
-                for spectator in spectators:
-                    asyncio.create_task(notify_spectator(spectator, orjson.dumps({'end-game': -1})))
-                print(f"[GAME END] {mode} PEACE")
+                settlement = await settle_peace(game, active_players)
+                peace = True
                 break
 
             if peace_timer:
@@ -1061,50 +2327,94 @@ async def game_session(mode, players, custom_map=None, score=True, spectators=No
                 merged |= data[i]
 
             data = orjson.dumps(merged)
+            work = time.perf_counter() - work_start
             await asyncio.gather(*[send_orjson(player.writer, data) for player in players])
+            work_start = time.perf_counter()
 
-            for spectator in spectators:
-                asyncio.create_task(notify_spectator(spectator, data))
+            tick += 1
+            game.tick = tick
+            game.last_state = data
+            if RECORD_REPLAYS:
+                replay_writer.frame(game_id, tick, data)
+            if tick % SNAPSHOT_TICKS == 0:
+                snapshot_game(game_id, mode, players, map_final, tick, data, score)
+
+            game.relay.publish(data)
+            tick_driver.record(game_id, work + time.perf_counter() - work_start)
 
-            elapsed = time.monotonic() - start_time
-            if elapsed < 1.03:
-                await asyncio.sleep(1.03 - elapsed)
+        # Scoring doesn't hold the game's connections, they are released right away
+        counted, winner, stats = settlement
+        track_task(score_settled(game, winner, stats, counted, score, started))
+        log_event('game-end', game_id=game_id, mode=mode, winner=players[winner].username if winner is not None else None,
+                  counted=counted, peace=peace)
 
     except Exception as e:
-        print(f"[ERROR] Game: {e}")
+        log_event('game-error', logging.ERROR, game_id=game_id, mode=mode, error=str(e))
     finally:
+        tick_driver.remove(game_id)
+        forget_snapshot(game_id)
+        live_games.pop(game_id)
+        if RECORD_REPLAYS:
+            replay_writer.close(game_id)
         for player in active_players:
             await disconnect(player)
-        for spectator in spectators:
-            await disconnect(spectator)
+        if game is not None and game.relay is not None:
+            # Spectators get the rest of their queue and the end, then are disconnected
+            game.relay.close(orjson.dumps({'end-game': -1}))
+        else:
+            for spectator in spectators:
+                await disconnect(spectator)
 
 
-async def matchmaking_rooms():
-    print(f"Matchmaking in rooms running")
-    while True:
-        async with room_lock:
-            for code in rooms:
-                asyncio.create_task(rooms[code].check_room())
-        await asyncio.sleep(4)
+def track_task(coroutine):
+    # Game and scoring tasks are waited for when the server drains
+    task = asyncio.create_task(coroutine)
+    game_tasks.add(task)
+    task.add_done_callback(game_tasks.discard)
+    return task
+
+
+def start_game(mode, players, **kwargs):
+    return track_task(game_session(mode, players, **kwargs))
+
+
+async def turn_away(players, queue=None):
+    # While draining, waiting players are sent back so they can queue on the new process
+    if queue is not None:
+        while not queue.empty():
+            players.append(queue.get_nowait())
+
+    for player in players:
+        await send_orjson(player.writer, orjson.dumps({'status': 0, 'error': 'server-draining'}))
+        await disconnect(player)
+    players.clear()
 
 
 async def matchmaking_1v1():
-    print(f"Matchmaking 1v1 running")
+    log_event('matchmaking-start', mode='1v1')
+    last_sweep = time.monotonic()
     while True:
         players = []
 
         while len(players) < 2:
+            waiting_counts['1v1'] = len(players)
+            if draining:
+                await turn_away(players, queue_1v1)
+
             try:
                 player = queue_1v1.get_nowait()
                 players.append(player)
             except asyncio.QueueEmpty:
                 # Remove disconnected players from the current list
-                for i in range(len(players) - 1, -1, -1):
-                    if not await is_connected(players[i]):
-                        await disconnect(players[i])
-                        players.pop(i)
+                sweep = sweep_due(last_sweep)
+                if sweep:
+                    last_sweep = time.monotonic()
+                await prune_players(players, sweep)
                 await asyncio.sleep(10)
 
+            if len(players) == 2:
+                await prune_players(players)
+
         players.sort(key=lambda p: p.score)
 
         matches = []
@@ -1114,46 +2424,55 @@ async def matchmaking_1v1():
             players = players[2:]
 
         for match_players in matches:
-            asyncio.create_task(game_session('1v1', match_players))
+            start_game('1v1', match_players)
 
 
 async def matchmaking_v34():
-    print(f"Matchmaking v34 running")
+    log_event('matchmaking-start', mode='v34')
     players_v3 = []
     players_v4 = []
     players_v34 = []
+    last_sweep = time.monotonic()
     while True:
         while len(players_v3) + len(players_v34) < 3 and len(players_v4) + len(players_v34) < 4:
+            waiting_counts['v3'] = len(players_v3)
+            waiting_counts['v4'] = len(players_v4)
+            waiting_counts['v34'] = len(players_v34)
+            if draining:
+                await turn_away(players_v3, queue_v3)
+                await turn_away(players_v4, queue_v4)
+                await turn_away(players_v34, queue_v34)
+
+            sweep = sweep_due(last_sweep)
+            if sweep:
+                last_sweep = time.monotonic()
+
             try:
                 player = queue_v3.get_nowait()
                 players_v3.append(player)
             except asyncio.QueueEmpty:
-                for i in range(len(players_v3) - 1, -1, -1):
-                    if not await is_connected(players_v3[i]):
-                        await disconnect(players_v3[i])
-                        players_v3.pop(i)
+                await prune_players(players_v3, sweep)
                 await asyncio.sleep(1)
 
             try:
                 player = queue_v4.get_nowait()
                 players_v4.append(player)
             except asyncio.QueueEmpty:
-                for i in range(len(players_v4) - 1, -1, -1):
-                    if not await is_connected(players_v4[i]):
-                        await disconnect(players_v4[i])
-                        players_v4.pop(i)
+                await prune_players(players_v4, sweep)
                 await asyncio.sleep(1)
 
             try:
                 player = queue_v34.get_nowait()
                 players_v34.append(player)
             except asyncio.QueueEmpty:
-                for i in range(len(players_v34) - 1, -1, -1):
-                    if not await is_connected(players_v34[i]):
-                        await disconnect(players_v34[i])
-                        players_v34.pop(i)
+                await prune_players(players_v34, sweep)
                 await asyncio.sleep(1)
 
+            if len(players_v3) + len(players_v34) >= 3 or len(players_v4) + len(players_v34) >= 4:
+                await prune_players(players_v3)
+                await prune_players(players_v4)
+                await prune_players(players_v34)
+
         if len(players_v4) + len(players_v34) >= 4:
             selected_players = []
             while len(selected_players) < 4:
@@ -1164,7 +2483,7 @@ async def matchmaking_v34():
                     selected_players.append(players_v34[0])
                     players_v34.pop(0)
 
-            asyncio.create_task(game_session('v4', selected_players))
+            start_game('v4', selected_players)
         else:
             selected_players = []
             while len(selected_players) < 3:
@@ -1175,23 +2494,20 @@ async def matchmaking_v34():
                     selected_players.append(players_v34[0])
                     players_v34.pop(0)
 
-            asyncio.create_task(game_session('v3', selected_players))
+            start_game('v3', selected_players)
 
 
 # USER ONLINE MANAGEMENT
-async def add_online_user(username):
-    async with online_users_lock:
-        online_users.add(username)
+def add_online_user(username):
+    online_users.set(username)
 
 
-async def remove_online_user(username):
-    async with online_users_lock:
-        online_users.discard(username)
+def remove_online_user(username):
+    online_users.pop(username)
 
 
-async def is_user_online(username):
-    async with online_users_lock:
-        return username in online_users
+def is_user_online(username):
+    return username in online_users
 
 
 async def authorize(username, password):
@@ -1215,6 +2531,204 @@ async def authorize(username, password):
     return 1 if result else 0
 
 
+# MENU REQUESTS
+
+async def menu_get_stats(username, message):
+    status, error, response = await get_stats(username)
+    response['status'] = status
+    if error is not None:
+        response['error'] = error
+    return response
+
+
+async def menu_buy_item(username, message):
+    item = message['item']
+    price = message['price']
+    status, error = await buy_item(username, item, price)
+    response = {'status': status}
+    if error is not None:
+        response['error'] = error
+    return response
+
+
+async def menu_set_title(username, message):
+    await set_title(username, message['title'])
+
+
+async def menu_campaign_delta(username, message):
+    # The client sends the levels it completed since the last sync and the mask it already has,
+    # and gets back only the levels it is missing
+    completed = campaign_mask(message.get('completed', []))
+    known = message.get('known', 0)
+    if not isinstance(known, int) or isinstance(known, bool):
+        return {'status': 0, 'error': 'sync-campaign-fail'}
+
+    mask = await merge_campaign(username, completed)
+    if mask is None:
+        return {'status': 0, 'error': 'user-not-found'}
+    return {'status': 1, 'missing': campaign_levels(mask & ~(known | completed)), 'mask': mask,
+            'completed': bin(mask).count('1') >= CAMPAIGN_LEVELS}
+
+
+async def menu_sync_campaign(username, message):
+    progress = message['progress']
+    status, error, progress, completed = await sync_campaign(username, progress)
+    response = {'status': status, 'progress': progress, 'completed': completed}
+    if error is not None:
+        response['error'] = error
+    return response
+
+
+async def menu_match_history(username, message):
+    before = message.get('before')
+    limit = message.get('limit', MATCH_HISTORY_LIMIT)
+    if not isinstance(before, (int, type(None))) or not isinstance(limit, int):
+        return {'status': 0, 'error': 'request-fail'}
+    matches = await get_match_history(username, before, max(1, min(limit, MATCH_HISTORY_LIMIT)))
+    return {'status': 1, 'matches': matches}
+
+
+MENU_REQUESTS = {
+    'get-stats': menu_get_stats,
+    'buy-item': menu_buy_item,
+    'set-title': menu_set_title,
+    'sync-campaign': menu_sync_campaign,
+    'campaign-delta': menu_campaign_delta,
+    'match-history': menu_match_history,
+}
+
+
+async def lobby_session(username, reader, writer):
+    # One authenticated connection carrying many menu requests, answered by id in completion order
+    global active_handlers, lobby_sessions
+    if lobby_sessions >= MAX_LOBBY_SESSIONS:
+        admission_stats['rejected-busy'] += 1
+        await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'busy-fail'}))
+        return
+
+    # Idle menu connections have their own limit, they don't take the handler slots of players
+    # joining games and queues
+    active_handlers -= 1
+    lobby_sessions += 1
+    try:
+        await send_orjson(writer, orjson.dumps({'status': 1}))
+        await serve_lobby(username, reader, writer)
+    finally:
+        lobby_sessions -= 1
+        active_handlers += 1
+
+
+async def serve_lobby(username, reader, writer):
+    peer = writer.get_extra_info('peername')
+    bucket = ip_bucket(peer[0] if peer else None)
+    in_flight = asyncio.Semaphore(LOBBY_MAX_IN_FLIGHT)
+    tasks = set()
+
+    async def answer(request_id, message):
+        try:
+            handler = MENU_REQUESTS.get(message.get('type'))
+            if handler is None:
+                response = {'status': 0, 'error': 'request-fail'}
+            else:
+                response = await handler(username, message) or {'status': 1}
+        except Exception as e:
+            log_event('lobby-request-error', level=logging.WARNING, username=username, error=repr(e))
+            response = {'status': 0, 'error': 'request-fail'}
+        finally:
+            in_flight.release()
+        response['id'] = request_id
+        await send_orjson(writer, orjson.dumps(response))
+
+    try:
+        while True:
+            message = await read_orjson(reader, timeout=LOBBY_IDLE_TIMEOUT)
+            if message == 0:
+                return
+            message = orjson.loads(message)
+            request_id = message.get('id')
+
+            if not bucket.take():
+                admission_stats['rejected-rate'] += 1
+                await send_orjson(writer, orjson.dumps({'id': request_id, 'status': 0, 'error': 'rate-fail'}))
+                continue
+
+            await in_flight.acquire()
+            task = asyncio.create_task(answer(request_id, message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# ADMISSION CONTROL
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+ip_buckets = OrderedDict()
+active_handlers = 0
+lobby_sessions = 0
+admission_stats = Counter()
+
+
+def ip_bucket(ip):
+    bucket = ip_buckets.get(ip)
+    if bucket is None:
+        bucket = TokenBucket(IP_REQUEST_RATE, IP_REQUEST_BURST)
+        ip_buckets[ip] = bucket
+        if len(ip_buckets) > MAX_TRACKED_IPS:
+            ip_buckets.popitem(last=False)
+    else:
+        ip_buckets.move_to_end(ip)
+    return bucket
+
+
+def reject_client(writer, error):
+    # Fast path: no reading and no waiting for the peer
+    admission_stats[f'rejected-{error}'] += 1
+    try:
+        message = orjson.dumps({'status': 0, 'error': f'{error}-fail'})
+        writer.write(struct.pack('>I', len(message)) + message)
+        writer.close()
+    except Exception as e:
+        pass
+
+
+async def admit_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    global active_handlers
+
+    if active_handlers >= MAX_ACTIVE_HANDLERS:
+        reject_client(writer, 'busy')
+        return
+
+    peer = writer.get_extra_info('peername')
+    if not ip_bucket(peer[0] if peer else None).take():
+        reject_client(writer, 'rate')
+        return
+
+    admission_stats['admitted'] += 1
+    active_handlers += 1
+    try:
+        await handle_client(reader, writer)
+    finally:
+        active_handlers -= 1
+
+
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     player = None
 
@@ -1235,22 +2749,13 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
             status, error = await register_user(message['username'], message['email'])
             await send_orjson(writer, orjson.dumps({'status': status, 'error': error}))
             if status:
-                print(f"Successfully registered {message['username']} at {message['email']}")
-                await asyncio.sleep(1800)  # 30 minutes
-                status = await check_if_active(message['username'])
-                if not status:
-                    # Done only if no confirmation appeared
-                    async with pending_codes_lock:
-                        del pending_codes[message['username']]
-                    await delete_user(message['username'])
+                log_event('registered', username=message['username'], email=message['email'])
+                asyncio.create_task(expire_registration(message['username']))
             return
 
         elif connection_type == 'login1':
             status, error = await login1(message['username'], message['email'])
             await send_orjson(writer, orjson.dumps({'status': status, 'error': error}))
-            await asyncio.sleep(1800)  # 30 minutes
-            async with pending_codes_lock:
-                del pending_codes[message['username']]
             return
 
         elif connection_type == 'login2':
@@ -1276,89 +2781,135 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
             await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'authorize-fail'}))
             return
 
-        if connection_type == 'get-stats':
-            status, error, response = await get_stats(username)
-            response['status'] = status
-            if error is not None:
-                response['error'] = error
-            await send_orjson(writer, orjson.dumps(response))
+        if connection_type == 'resume':
+            game = live_games.get(message['game_id'])
+            if game is not None:
+                player = game.reattach(username, message.get('token'), reader, writer)
+                if player is None:
+                    await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'resume-fail'}))
+                    return
+
+                sock = writer.get_extra_info('socket')
+                if sock:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    set_keepalive(sock)
+                log_event('reconnect', game_id=game.game_id, username=username)
+                return
+
+            if is_user_online(username):
+                await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'user-online-fail'}))
+                return
+
+            player = Player(username=username, reader=reader, writer=writer, score=await get_score(username))
+            add_online_user(username)
+            if not await resume_player(message['game_id'], player):
+                remove_online_user(username)
+                player = None
+                await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'resume-fail'}))
+                return
+
+            watch_waiting(player)
+            await send_orjson(writer, orjson.dumps({'status': 1}))
+            log_event('resume', game_id=message['game_id'], username=username)
+            return
+
+        if connection_type == 'spectate':
+            game = live_games.get(message['game_id'])
+            if game is None or game.relay is None:
+                await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'game-not-found'}))
+                return
+            if is_user_online(username):
+                await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'user-online-fail'}))
+                return
+
+            player = Player(username=username, reader=reader, writer=writer, score=0)
+            add_online_user(username)
+            await send_orjson(writer, orjson.dumps({'status': 1}))
+            game.relay.add(player)
+            log_event('spectate', game_id=game.game_id, username=username)
             return
 
-        if connection_type == 'buy-item':
-            item = message['item']
-            price = message['price']
-            status, error = await buy_item(username, item, price)
-            response = {'status': status}
-            if error is not None:
-                response['error'] = error
-            await send_orjson(writer, orjson.dumps(response))
+        if connection_type == 'replay':
+            await stream_replay(writer, message['game_id'], message.get('from_tick', 0), message.get('speed', 1))
             return
 
-        if connection_type == 'set-title':
-            await set_title(username, message['title'])
+        if connection_type in MENU_REQUESTS:
+            response = await MENU_REQUESTS[connection_type](username, message)
+            if response is not None:
+                await send_orjson(writer, orjson.dumps(response))
             return
 
-        if connection_type == 'sync-campaign':
-            progress = message['progress']
-            status, error, progress, completed = await sync_campaign(username, progress)
-            response = {'status': status, 'progress': progress, 'completed': completed}
-            if error is not None:
-                response['error'] = error
-            await send_orjson(writer, orjson.dumps(response))
+        if connection_type == 'lobby-session':
+            await lobby_session(username, reader, writer)
             return
 
-        if not await is_user_online(username):
+        if draining:
+            await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'server-draining'}))
+            return
+
+        if not is_user_online(username):
 
             # No Delay Set Up
             sock = writer.get_extra_info('socket')
             if sock:
                 sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                set_keepalive(sock)
 
             player = Player(username=username, reader=reader, writer=writer, score=await get_score(username))
-            await add_online_user(username)
+            add_online_user(username)
+            watch_waiting(player)
             code = message['code']
             if code:
-                if await room_exists(code):
+                if room_exists(code):
                     await send_orjson(player.writer, orjson.dumps({'status': 1}))
-                    await rooms[code].add_player(player)
-                    print(f"[QUEUE] {username} joined a game room")
+                    await rooms.get(code).add_player(player)
+                    log_event('room-join', username=username, code=code)
                 else:
                     custom_map = message['custom_map']
-                    if custom_map:
+                    known_map = map_store.get(message['map_hash']) if custom_map and message.get('map_hash') else None
+                    if known_map:
+                        # The client does not need to upload a map the server already has
+                        await send_orjson(player.writer, orjson.dumps({'status': 1, 'action': None}))
+                        custom_map = known_map
+                    elif custom_map:
                         await send_orjson(player.writer, orjson.dumps({'status': 1, 'action': 'send-map'}))
-                        custom_map = await read_orjson(reader)
+                        custom_map = await read_orjson(reader, max_size=MAX_MAP_FRAME)
+                        if custom_map == 0:
+                            raise ValueError('custom map not received')
+                        custom_map = map_store.add(custom_map)
                     else:
                         await send_orjson(player.writer, orjson.dumps({'status': 1, 'action': None}))
                         custom_map = None
 
                     room = GameRoom(code, connection_type, custom_map)
-                    await create_game_room(code, room)
-                    await rooms[code].add_player(player)
-                    print(f"[QUEUE] {username} created a game room")
+                    create_game_room(code, room)
+                    await room.add_player(player)
+                    log_event('room-create', username=username, code=code, mode=connection_type)
             elif connection_type == '1v1':
                 await queue_1v1.put(player)
                 await send_orjson(player.writer, orjson.dumps({'status': 1}))
-                print(f"[QUEUE] {username} joined 1v1 queue")
+                log_event('queue-join', username=username, mode='1v1')
             elif connection_type == 'v3':
                 await queue_v3.put(player)
                 await send_orjson(player.writer, orjson.dumps({'status': 1}))
-                print(f"[QUEUE] {username} joined v3 queue")
+                log_event('queue-join', username=username, mode='v3')
             elif connection_type == 'v4':
                 await queue_v4.put(player)
                 await send_orjson(player.writer, orjson.dumps({'status': 1}))
-                print(f"[QUEUE] {username} joined v4 queue")
+                log_event('queue-join', username=username, mode='v4')
             elif connection_type == 'v34':
                 await queue_v34.put(player)
                 await send_orjson(player.writer, orjson.dumps({'status': 1}))
-                print(f"[QUEUE] {username} joined v34 queue")
+                log_event('queue-join', username=username, mode='v34')
             else:
-                await remove_online_user(username)
+                unwatch_waiting(player)
+                remove_online_user(username)
                 await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'connection-fail'}))
                 player = None
-                print(f"[QUEUE] {username} failed to join queue")
+                log_event('queue-fail', logging.WARNING, username=username, mode=connection_type)
         else:
             await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'user-online-fail'}))
-            print(f"[QUEUE] {username} failed to join - already online")
+            log_event('queue-fail', logging.WARNING, username=username, mode=connection_type, error='already-online')
 
 
     except Exception as e:
@@ -1374,27 +2925,515 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
                 pass
 
 
+# DATABASE MAINTENANCE
+# Backups are copied with the sqlite backup API a few pages at a time, so writers only wait for
+# one step. Every step reports how long it held the database.
+
+maintenance_stats = {}
+
+
+def enable_wal():
+    # Readers no longer block the writer and the other way round, the mode is stored in the file
+    conn = sqlite3.connect(database_name)
+    mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    conn.close()
+    return mode
+
+
+def backup_database():
+    # Blocking. Returns the backup path, the longest time one step held the database and the step count
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_DIR, f'database-{time.strftime("%Y%m%d-%H%M%S")}.db')
+    steps = []
+    step_start = time.perf_counter()
+
+    def progress(status, remaining, total):
+        nonlocal step_start
+        steps.append(time.perf_counter() - step_start)
+        # The pause lets writers in between steps
+        time.sleep(BACKUP_STEP_PAUSE)
+        step_start = time.perf_counter()
+
+    source = sqlite3.connect(database_name)
+    target = sqlite3.connect(path + '.tmp')
+    try:
+        if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # Copy from one snapshot. Writers carry on in the WAL, otherwise every write
+            # from another connection would restart the backup from the first page
+            source.execute('BEGIN')
+            source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        source.backup(target, pages=BACKUP_PAGES, progress=progress)
+    finally:
+        target.close()
+        source.close()
+    os.replace(path + '.tmp', path)
+
+    # Oldest first, the names sort by time
+    backups = sorted(name for name in os.listdir(BACKUP_DIR) if name.startswith('database-') and name.endswith('.db'))
+    for name in backups[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, name))
+    return path, max(steps, default=0.0), len(steps)
+
+
+def run_statement(*statements):
+    # Blocking. Returns the result of the last statement and how long they held the database
+    conn = sqlite3.connect(database_name)
+    start = time.perf_counter()
+    try:
+        for statement in statements:
+            result = conn.execute(statement).fetchall()
+    finally:
+        conn.close()
+    return result, time.perf_counter() - start
+
+
+async def maintenance_step(name):
+    start = time.perf_counter()
+    try:
+        if name == 'backup':
+            path, lock_held, steps = await asyncio.to_thread(backup_database)
+            fields = {'path': path, 'steps': steps}
+        elif name == 'optimize':
+            # A sampled ANALYZE keeps the statistics current without reading every row
+            result, lock_held = await asyncio.to_thread(run_statement, f'PRAGMA analysis_limit={ANALYZE_LIMIT}', 'ANALYZE',
+                                                        'PRAGMA optimize')
+            fields = {}
+        elif name == 'checkpoint':
+            # A full checkpoint only when it is quiet, it waits for readers
+            mode = 'TRUNCATE' if low_load() else 'PASSIVE'
+            result, lock_held = await asyncio.to_thread(run_statement, f'PRAGMA wal_checkpoint({mode})')
+            busy, log_pages, checkpointed = result[0]
+            fields = {'mode': mode, 'busy': busy, 'wal_pages': log_pages, 'checkpointed': checkpointed}
+        elif name == 'replays':
+            # Games still running or waiting to be resumed keep writing to their replays
+            live = {game.game_id for game in live_games.values()} | {orphan['game_id'] for orphan in orphaned_games.values()}
+            removed = await asyncio.to_thread(prune_replays, live)
+            lock_held = 0.0
+            fields = {'removed': removed}
+    except (sqlite3.Error, OSError) as e:
+        log_event('maintenance-error', logging.ERROR, step=name, error=str(e))
+        return {'status': 0, 'error': str(e)}
+
+    seconds = time.perf_counter() - start
+    maintenance_stats[name] = {'seconds': seconds, 'lock_held_ms': lock_held * 1e3, 'at': time.time()}
+    log_event('maintenance', step=name, seconds=round(seconds, 3), lock_held_ms=round(lock_held * 1e3, 2), **fields)
+    return {'status': 1, 'message': f"{name} took {seconds:.2f}s, held the database for at most {lock_held * 1e3:.1f}ms"}
+
+
+def low_load():
+    return len(live_games) <= MAINTENANCE_MAX_GAMES and loop_lag['last'] < 0.05
+
+
+async def maintenance_scheduler():
+    intervals = {'checkpoint': CHECKPOINT_INTERVAL, 'optimize': OPTIMIZE_INTERVAL, 'backup': BACKUP_INTERVAL,
+                 'replays': REPLAY_PRUNE_INTERVAL}
+    last_run = {name: time.monotonic() for name in intervals}
+    while True:
+        await asyncio.sleep(MAINTENANCE_CHECK_INTERVAL)
+        for name, interval in intervals.items():
+            overdue = time.monotonic() - last_run[name]
+            # Waits for a quiet moment, but not more than one extra interval
+            if overdue >= interval and (low_load() or overdue >= 2 * interval):
+                await maintenance_step(name)
+                last_run[name] = time.monotonic()
+
+
+# METRICS
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - start - LOOP_LAG_INTERVAL)
+        loop_lag['last'] = lag
+        loop_lag['max'] = max(loop_lag['max'], lag)
+        loop_lag['total'] += lag
+
+
+def collect_metrics():
+    executor = getattr(asyncio.get_running_loop(), '_default_executor', None)
+    work_queue = getattr(executor, '_work_queue', None)
+
+    metrics = {
+        'queue_waiting{mode="1v1"}': queue_1v1.qsize() + waiting_counts['1v1'],
+        'queue_waiting{mode="v3"}': queue_v3.qsize() + waiting_counts['v3'],
+        'queue_waiting{mode="v4"}': queue_v4.qsize() + waiting_counts['v4'],
+        'queue_waiting{mode="v34"}': queue_v34.qsize() + waiting_counts['v34'],
+        'rooms': len(rooms),
+        'live_games': len(live_games),
+        'game_tasks': len(game_tasks),
+        'spectators': sum(len(game.relay.spectators) for game in live_games.values() if game.relay is not None),
+        'online_users': len(online_users),
+        'active_handlers': active_handlers,
+        'lobby_sessions': lobby_sessions,
+        'draining': int(draining),
+        'loop_lag_seconds': loop_lag['last'],
+        'loop_lag_max_seconds': loop_lag['max'],
+        'loop_lag_seconds_total': loop_lag['total'],
+        'asyncio_tasks': len(asyncio.all_tasks()),
+        'executor_queue_depth': work_queue.qsize() if work_queue is not None else 0,
+        'executor_threads': len(getattr(executor, '_threads', ())),
+    }
+    for key, value in admission_stats.items():
+        metrics[f'admission{{result="{key}"}}'] = value
+    for key, value in profile_cache.stats().items():
+        metrics[f'profile_cache_{key}'] = value
+    for key, value in map_store.stats().items():
+        metrics[f'map_store_{key}'] = value
+    for key, value in snapshot_report().items():
+        metrics[f'snapshot_{key}'] = value
+    for key, value in match_stats.items():
+        metrics[f'match_{key.replace("-", "_")}'] = value
+    metrics['match_queue_depth'] = match_results.qsize()
+    for key, value in tick_driver.report().items():
+        metrics[f'tick_{key}'] = value
+    for name, step in maintenance_stats.items():
+        metrics[f'maintenance_seconds{{step="{name}"}}'] = step['seconds']
+        metrics[f'maintenance_lock_held_ms{{step="{name}"}}'] = step['lock_held_ms']
+        metrics[f'maintenance_last_run{{step="{name}"}}'] = step['at']
+    if PROFILE:
+        metrics['profile_stalls'] = profiler.stalls
+    return metrics
+
+
+async def handle_metrics(reader, writer):
+    try:
+        # Plain HTTP, the request itself is not looked at beyond its headers
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+        body = ''.join(f'wod_{key} {value}\n' for key, value in collect_metrics().items()).encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except Exception as e:
+        pass
+    finally:
+        writer.close()
+
+
+# ADMIN CONTROL
+# Admin commands are applied by the server itself, so they don't race its own writes on the
+# database and the caches and indexes are kept in step. One request per connection.
+
+ADMIN_FIELDS = USER_COLUMNS
+
+
+def admin_token():
+    global ADMIN_TOKEN
+    if ADMIN_TOKEN is None:
+        ADMIN_TOKEN = os.urandom(16).hex()
+        descriptor = os.open(ADMIN_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            file.write(ADMIN_TOKEN)
+    return ADMIN_TOKEN
+
+
+async def admin_update(username, query, parameters):
+    def blocking_update():
+        conn = sqlite3.connect(database_name)
+        c = conn.cursor()
+        c.execute(query, parameters)
+        conn.commit()
+        changed = c.rowcount
+        conn.close()
+        return changed
+
+    changed = await asyncio.to_thread(blocking_update)
+    profile_cache.invalidate(username)
+    return changed
+
+
+async def admin_give(message):
+    username, amount = message['username'], int(message['amount'])
+    if not await admin_update(username, 'UPDATE users SET money = money + ? WHERE username = ?', (amount, username)):
+        return {'status': 0, 'error': f"No user found with username '{username}'."}
+    return {'status': 1, 'message': f"Money for '{username}' increased by {amount}."}
+
+
+async def admin_clear(message):
+    username = message['username']
+    if not await admin_update(username, 'UPDATE users SET items = ? WHERE username = ?', ('[]', username)):
+        return {'status': 0, 'error': f"No user found with username '{username}'."}
+    return {'status': 1, 'message': f"Items for '{username}' reset to []."}
+
+
+async def admin_change(message):
+    username, field, value = message['username'], message['field'], message['value']
+    if field not in ADMIN_FIELDS:
+        return {'status': 0, 'error': f"Invalid field name: {field}"}
+    if not await admin_update(username, f'UPDATE users SET {field} = ? WHERE username = ?', (value, username)):
+        return {'status': 0, 'error': f"No user found with username '{username}'."}
+
+    if field in ('email', 'steam_id'):
+        # Re-index the account under its new email or steam id
+        def blocking_lookup():
+            conn = sqlite3.connect(database_name)
+            c = conn.cursor()
+            c.execute('SELECT email, steam_id FROM users WHERE username = ?', (username,))
+            row = c.fetchone()
+            conn.close()
+            return row
+
+        row = await asyncio.to_thread(blocking_lookup)
+        membership.remove(username)
+        if row is not None:
+            membership.add(username, *row)
+    return {'status': 1, 'message': f"Field '{field}' of '{username}' set."}
+
+
+async def admin_delete(message):
+    username = message['username']
+    await delete_user(username)
+    return {'status': 1, 'message': f"User '{username}' deleted."}
+
+
+async def admin_maintenance(message):
+    # Runs one maintenance step now, whatever the load
+    step = message.get('step')
+    if step not in ('backup', 'optimize', 'checkpoint', 'replays'):
+        return {'status': 0, 'error': f"Unknown maintenance step: {step}"}
+    return await maintenance_step(step)
+
+
+async def admin_invalidate(message):
+    # After bulk writes to the database file by database_manager.py
+    profile_cache.clear()
+    if message.get('membership'):
+        membership.clear()
+        await load_membership_index()
+    return {'status': 1, 'message': 'Server caches dropped.'}
+
+
+ADMIN_COMMANDS = {
+    'give': admin_give,
+    'clear': admin_clear,
+    'change': admin_change,
+    'delete': admin_delete,
+    'invalidate': admin_invalidate,
+    'maintenance': admin_maintenance,
+}
+
+
+async def handle_admin(reader, writer):
+    try:
+        message = await read_orjson(reader)
+        if message == 0:
+            return
+        message = orjson.loads(message)
+
+        token = message.get('token')
+        if not isinstance(token, str) or not hmac.compare_digest(token, admin_token()):
+            log_event('admin-denied', logging.WARNING, command=message.get('command'))
+            await send_orjson(writer, orjson.dumps({'status': 0, 'error': 'auth-fail'}))
+            return
+
+        command = ADMIN_COMMANDS.get(message.get('command'))
+        if command is None:
+            response = {'status': 0, 'error': f"Unknown command: {message.get('command')}"}
+        else:
+            try:
+                response = await command(message)
+            except (KeyError, ValueError, TypeError, sqlite3.Error) as e:
+                response = {'status': 0, 'error': str(e)}
+        log_event('admin-command', command=message.get('command'), username=message.get('username'), status=response['status'])
+        await send_orjson(writer, orjson.dumps(response))
+    except Exception as e:
+        log_event('admin-error', logging.ERROR, error=str(e))
+    finally:
+        writer.close()
+
+
+# PROFILING
+
+class LoopProfiler:
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.samples = Counter()
+        self.stalls = 0
+        self.lock = threading.Lock()
+        self.thread_id = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        asyncio.create_task(self.beat())
+        threading.Thread(target=self.sample, name='loop-profiler', daemon=True).start()
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def sample(self):
+        stalled = False
+        while True:
+            time.sleep(self.interval)
+            if time.monotonic() - self.heartbeat < self.threshold + self.interval:
+                stalled = False
+                continue
+
+            # The loop has not run the heartbeat for too long, see what it is doing
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            folded = ';'.join(reversed(stack))
+
+            with self.lock:
+                self.samples[folded] += 1
+                if not stalled:
+                    self.stalls += 1
+                    stalled = True
+
+    def take(self):
+        with self.lock:
+            samples, self.samples = self.samples, Counter()
+        return samples
+
+
+profiler = LoopProfiler(PROFILE_THRESHOLD, PROFILE_SAMPLE_INTERVAL)
+
+
+async def dump_profile():
+    samples = profiler.take()
+
+    def blocking_dump():
+        # Folded stacks, one "frame;frame;frame count" line each, ready for flamegraph.pl or speedscope
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f'profile-{os.getpid()}-{int(time.time())}.folded')
+        with open(path, 'w') as file:
+            for stack, count in samples.most_common():
+                file.write(f'{stack} {count}\n')
+        return path
+
+    path = await asyncio.to_thread(blocking_dump)
+    log_event('profile-dump', path=path, stacks=len(samples), stalls=profiler.stalls,
+              blocked_seconds=round(sum(samples.values()) * PROFILE_SAMPLE_INTERVAL, 3))
+
+
+# DRAIN AND HAND-OFF
+
+async def drain():
+    global draining
+    if draining:
+        return
+    draining = True
+    log_event('drain-start', games=len(game_tasks), rooms=len(rooms))
+
+    # Rooms that haven't started are closed like the queues
+    for room in rooms.values():
+        room.events.put_nowait(('drain', None, None))
+
+    # Queued players leave once the matchmakers turn them away, results and the removal of
+    # finished snapshots are written before exiting
+    while (game_tasks or len(live_games) or len(online_users) or not match_results.empty() or match_stats['in-flight']
+           or pending_snapshots or snapshot_stats['in-flight']):
+        await asyncio.sleep(1)
+
+    log_event('drain-done')
+    shutdown_event.set()
+
+
+def hand_off(servers, local_servers=()):
+    # The metrics and admin ports are not shared, the new process binds them itself
+    for server in local_servers:
+        server.close()
+
+    # The new process inherits the listening sockets, so connections keep being accepted throughout
+    fds = [sock.fileno() for server in servers for sock in server.sockets]
+    for fd in fds:
+        os.set_inheritable(fd, True)
+
+    env = os.environ | {'WOD_LISTEN_FDS': ','.join(str(fd) for fd in fds)}
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, pass_fds=fds)
+    log_event('hand-off', pid=process.pid)
+
+    for server in servers:
+        server.close()
+    asyncio.create_task(drain())
+
+
 async def main():
-    global queue_1v1, queue_v3, queue_v4, queue_v34, online_users_lock, room_lock, pending_codes_lock
+    global queue_1v1, queue_v3, queue_v4, queue_v34, match_results, ping_semaphore, shutdown_event
 
     queue_1v1 = asyncio.Queue()
     queue_v3 = asyncio.Queue()
     queue_v4 = asyncio.Queue()
     queue_v34 = asyncio.Queue()
-    online_users_lock = asyncio.Lock()
-    room_lock = asyncio.Lock()
-    pending_codes_lock = asyncio.Lock()
+    match_results = asyncio.Queue()
+    ping_semaphore = asyncio.Semaphore(PING_SWEEP_CONCURRENCY)
+    shutdown_event = asyncio.Event()
+    setup_logging()
 
     server_ip = "0.0.0.0"
     server_port = 9056
 
+    await load_membership_index()
+    await asyncio.to_thread(init_matches)
+    converted = await asyncio.to_thread(init_campaign_mask)
+    if converted:
+        log_event('campaign-mask-added', users=converted)
+    log_event('journal-mode', mode=await asyncio.to_thread(enable_wal))
+    await load_orphaned_games()
+    asyncio.create_task(monitor_loop_lag())
+    if PROFILE:
+        profiler.start()
+    try:
+        metrics_server = await asyncio.start_server(handle_metrics, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        metrics_server = None
+        log_event('metrics-error', logging.ERROR, error=str(e))
+    try:
+        admin_token()
+        admin_server = await asyncio.start_server(handle_admin, ADMIN_HOST, ADMIN_PORT)
+    except OSError as e:
+        admin_server = None
+        log_event('admin-error', logging.ERROR, error=str(e))
+    if RECORD_REPLAYS:
+        replay_writer.start()
+    asyncio.create_task(snapshot_writer())
+    asyncio.create_task(match_writer())
+    asyncio.create_task(maintenance_scheduler())
+    asyncio.create_task(tick_driver.run())
+
     asyncio.create_task(matchmaking_1v1())
     asyncio.create_task(matchmaking_v34())
-    asyncio.create_task(matchmaking_rooms())
-    server = await asyncio.start_server(handle_client, server_ip, server_port)
-    print(f"Server started at {server_ip}:{server_port}")
-    async with server:
-        await server.serve_forever()
+    loop = asyncio.get_running_loop()
+
+    def client_protocol():
+        reader = asyncio.StreamReader(loop=loop)
+        return ClientProtocol(reader, admit_client, loop=loop)
+
+    listen_fds = os.getenv('WOD_LISTEN_FDS')
+    if listen_fds:
+        # Started by hand_off, accept on the sockets of the previous process
+        servers = [await loop.create_server(client_protocol, sock=socket.socket(fileno=int(fd))) for fd in listen_fds.split(',')]
+        log_event('server-start', fds=listen_fds)
+    else:
+        servers = [await loop.create_server(client_protocol, server_ip, server_port)]
+        log_event('server-start', host=server_ip, port=server_port)
+
+    try:
+        # SIGTERM drains and exits, SIGUSR2 starts a replacement process first, SIGUSR1 dumps the profile
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(drain()))
+        local_servers = [server for server in (metrics_server, admin_server) if server is not None]
+        loop.add_signal_handler(signal.SIGUSR2, lambda: hand_off(servers, local_servers))
+        if PROFILE:
+            loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(dump_profile()))
+    except (NotImplementedError, AttributeError):
+        pass
+
+    try:
+        await shutdown_event.wait()
+    finally:
+        for server in servers:
+            server.close()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import asyncio
+import struct
+import time
+import orjson
+import server
+
+
+# Times the shared state operations of a queue join (online check and add, room check, login
+# code read, removal) the way the server did them before state_registry, a set or dict behind
+# an asyncio.Lock each, and through the server's functions now. Also runs whole v34 queue joins
+# through handle_client with a fed stream. No database is involved, authorization and the score
+# lookup are replaced while it runs.
+
+JOIN_USERNAME = 'benchmark-user'
+
+
+class LockedState:
+    # online_users, rooms and pending_codes as they were guarded before the registry
+    def __init__(self):
+        self.online_users = set()
+        self.online_users_lock = asyncio.Lock()
+        self.rooms = {}
+        self.room_lock = asyncio.Lock()
+        self.pending_codes = {}
+        self.pending_codes_lock = asyncio.Lock()
+
+    async def add_online_user(self, username):
+        async with self.online_users_lock:
+            self.online_users.add(username)
+
+    async def remove_online_user(self, username):
+        async with self.online_users_lock:
+            self.online_users.discard(username)
+
+    async def is_user_online(self, username):
+        async with self.online_users_lock:
+            return username in self.online_users
+
+    async def room_exists(self, code):
+        async with self.room_lock:
+            return code in self.rooms
+
+    async def pending_code(self, username):
+        async with self.pending_codes_lock:
+            return self.pending_codes.get(username)
+
+
+async def locked_state_ops(requests):
+    state = LockedState()
+    start = time.perf_counter()
+    for i in range(requests):
+        await state.is_user_online(JOIN_USERNAME)
+        await state.add_online_user(JOIN_USERNAME)
+        await state.room_exists('code')
+        await state.pending_code(JOIN_USERNAME)
+        await state.remove_online_user(JOIN_USERNAME)
+    return time.perf_counter() - start
+
+
+async def registry_state_ops(requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        server.is_user_online(JOIN_USERNAME)
+        server.add_online_user(JOIN_USERNAME)
+        server.room_exists('code')
+        server.pending_codes.get(JOIN_USERNAME)
+        server.remove_online_user(JOIN_USERNAME)
+    return time.perf_counter() - start
+
+
+class FedWriter:
+    # Takes the replies of handle_client and drops them
+    transport = None
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def get_extra_info(self, name):
+        return None
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+async def handle_client_joins(requests):
+    async def authorize(username, password):
+        return 1
+
+    async def get_score(username):
+        return server.rating.INITIAL_RATING
+
+    saved = server.authorize, server.get_score, server.queue_v34
+    server.authorize, server.get_score, server.queue_v34 = authorize, get_score, asyncio.Queue()
+    message = orjson.dumps({'version': '0.13.3', 'type': 'v34', 'username': JOIN_USERNAME, 'password': '', 'code': None})
+    frame = struct.pack('>I', len(message)) + message
+    try:
+        start = time.perf_counter()
+        for i in range(requests):
+            reader = asyncio.StreamReader()
+            reader.feed_data(frame)
+            await server.handle_client(reader, FedWriter())
+            server.queue_v34.get_nowait()
+            server.remove_online_user(JOIN_USERNAME)
+        return time.perf_counter() - start
+    finally:
+        server.authorize, server.get_score, server.queue_v34 = saved
+
+
+async def run_all(requests):
+    print(f"{requests} requests")
+    print(f"{'path':<28}{'us/request':>12}")
+    for name, measure in (('state ops, locked', locked_state_ops), ('state ops, registry', registry_state_ops),
+                          ('handle_client v34 join', handle_client_joins)):
+        seconds = await measure(requests)
+        print(f"{name:<28}{seconds / requests * 1e6:>12.2f}")
+
+
+def run(requests=50000):
+    asyncio.run(run_all(requests))
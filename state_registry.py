@@ -0,0 +1,72 @@
+import heapq
+import time
+
+
+# Shared server state lives on the event loop thread and no operation awaits,
+# so plain dicts are enough and no asyncio.Lock is needed around them.
+
+class Registry:
+    def __init__(self):
+        self.items = {}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        return self.items.get(key, default)
+
+    def set(self, key, value=True):
+        self.items[key] = value
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def values(self):
+        return list(self.items.values())
+
+
+class TTLRegistry:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.items = {}
+        self.expiry = []
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        self.purge()
+        return len(self.items)
+
+    def get(self, key, default=None):
+        entry = self.items.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self.items[key]
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self.items[key] = (value, expires)
+        heapq.heappush(self.expiry, (expires, key))
+        self.purge()
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        self.items.pop(key, None)
+        return default if value is None else value
+
+    def purge(self):
+        now = time.monotonic()
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry)
+            # The key may have been set again with a later expiry
+            entry = self.items.get(key)
+            if entry is not None and entry[1] == expires:
+                del self.items[key]
@@ -0,0 +1,17 @@
+# Columns of users that the admin tools may write, shared by server.py and database_manager.py
+# so neither accepts a field the other rejects. username is the key and is never in here.
+
+USER_COLUMNS = frozenset({
+    'password_hash',
+    'steam_id',
+    'score',
+    'number_of_wins',
+    'number_of_games',
+    'last_active',
+    'stats',
+    'email',
+    'title',
+    'money',
+    'items',
+    'campaign_mask',
+})